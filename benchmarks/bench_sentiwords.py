@@ -0,0 +1,88 @@
+"""
+Benchmark SentiWords tagging: the tagger in xtas, which uses a compiled,
+memory-mapped lexicon, against the original implementation, which looked
+up all n-grams up to the maximum length in a dict at every position.
+
+The documents are random sequences of SentiWords n-grams and other words,
+of increasing length. The time to load the lexicon is reported separately.
+Run from the top-level directory as
+
+    PYTHONPATH=. python benchmarks/bench_sentiwords.py
+"""
+
+from __future__ import print_function
+
+import random
+from timeit import default_timer as timer
+
+from xtas.tasks._sentiwords import load, read_lexicon, tag
+
+
+def ngram_tagger():
+    """The previous implementation, with a flat table of n-grams."""
+    table = dict(read_lexicon())
+    max_len = max(w.count(' ') for w in table)   # sic; see below
+
+    def tag_ngrams(words):
+        def try_position(i):
+            for j in xrange(max_len, 0, -1):
+                ngram = ' '.join(words[i:i+j])
+                try:
+                    return j, ngram, table[ngram]
+                except KeyError:
+                    pass
+
+        i = 0
+        while i < len(words):
+            try:
+                skip, ngram, polarity = try_position(i)
+                yield ngram, polarity
+                i += skip
+            except TypeError:
+                yield words[i], 0
+                i += 1
+
+    return tag_ngrams
+
+
+def make_document(n_words, ngrams, rng):
+    words = []
+    while len(words) < n_words:
+        if rng.random() < .3:
+            words.extend(rng.choice(ngrams).split(' '))
+        else:
+            words.append(rng.choice(["the", "a", "of", "xyzzy", "foo"]))
+    return words
+
+
+if __name__ == "__main__":
+    rng = random.Random(42)
+    ngrams = [w for w, _ in read_lexicon()]
+
+    load()      # compile the lexicon, if necessary
+    start = timer()
+    load()
+    print("load compiled lexicon: %.6f s" % (timer() - start))
+    start = timer()
+    tag_ngrams = ngram_tagger()
+    print("load dict: %.6f s" % (timer() - start))
+
+    print("%10s %12s %12s %8s" % ("words", "dict (s)", "xtas (s)",
+                                  "speedup"))
+    for n in [100, 1000, 10000, 100000]:
+        words = make_document(n, ngrams, rng)
+
+        start = timer()
+        expected = list(tag_ngrams(words))
+        t_ngrams = timer() - start
+
+        start = timer()
+        result = list(tag(words))
+        t_xtas = timer() - start
+
+        # The old implementation stopped one word short of the longest
+        # n-grams (of nine words), so results may differ in rare cases.
+        if result != expected:
+            print("(results differ)")
+        print("%10d %12.6f %12.6f %8.1f" % (len(words), t_ngrams, t_xtas,
+                                            t_ngrams / t_xtas))
@@ -0,0 +1,106 @@
+"""
+Benchmark the conversion of CoreNLP output to SAF (stanford_to_saf).
+
+The input is the output of CoreNLP with all annotators for a short document,
+repeated to get documents of increasing size. Run from the top-level
+directory as
+
+    PYTHONPATH=. python benchmarks/bench_stanford_to_saf.py
+
+CORENLP_HOME need not be set.
+"""
+
+from __future__ import print_function
+
+from timeit import default_timer as timer
+
+from xtas.tasks._corenlp import stanford_to_saf
+
+
+# Output for "John loves himself. Mary met him in Amsterdam."
+SENTENCES = [
+    """Sentence #{0} (4 tokens):
+John loves himself.
+[Text=John CharacterOffsetBegin={1} CharacterOffsetEnd={2} PartOfSpeech=NNP \
+Lemma=John NamedEntityTag=PERSON] [Text=loves CharacterOffsetBegin={3} \
+CharacterOffsetEnd={4} PartOfSpeech=VBZ Lemma=love NamedEntityTag=O] \
+[Text=himself CharacterOffsetBegin={5} CharacterOffsetEnd={6} \
+PartOfSpeech=PRP Lemma=himself NamedEntityTag=O] [Text=. \
+CharacterOffsetBegin={6} CharacterOffsetEnd={7} PartOfSpeech=. Lemma=. \
+NamedEntityTag=O]
+(ROOT
+(S
+(NP (NNP John))
+(VP (VBZ loves)
+(NP (PRP himself)))
+(. .)))
+
+root(ROOT-0, loves-2)
+nsubj(loves-2, John-1)
+dobj(loves-2, himself-3)
+
+""",
+    """Sentence #{0} (7 tokens):
+Mary met him in Amsterdam.
+[Text=Mary CharacterOffsetBegin={1} CharacterOffsetEnd={2} PartOfSpeech=NNP \
+Lemma=Mary NamedEntityTag=PERSON] [Text=met CharacterOffsetBegin={3} \
+CharacterOffsetEnd={4} PartOfSpeech=VBD Lemma=meet NamedEntityTag=O] \
+[Text=him CharacterOffsetBegin={5} CharacterOffsetEnd={6} PartOfSpeech=PRP \
+Lemma=he NamedEntityTag=O] [Text=in CharacterOffsetBegin={7} \
+CharacterOffsetEnd={8} PartOfSpeech=IN Lemma=in NamedEntityTag=O] \
+[Text=Amsterdam CharacterOffsetBegin={9} CharacterOffsetEnd={10} \
+PartOfSpeech=NNP Lemma=Amsterdam NamedEntityTag=LOCATION] [Text=. \
+CharacterOffsetBegin={10} CharacterOffsetEnd={11} PartOfSpeech=. Lemma=. \
+NamedEntityTag=O]
+(ROOT
+(S
+(NP (NNP Mary))
+(VP (VBD met)
+(NP (PRP him))
+(PP (IN in)
+(NP (NNP Amsterdam))))
+(. .)))
+
+root(ROOT-0, met-2)
+nsubj(met-2, Mary-1)
+dobj(met-2, him-3)
+prep_in(met-2, Amsterdam-5)
+
+""",
+]
+
+COREFERENCE = """Coreference set:
+(1,3,[3,4)) -> (1,1,[1,2)), that is: "himself" -> "John"
+(2,3,[3,4)) -> (1,1,[1,2)), that is: "him" -> "John"
+"""
+
+
+def corenlp_output(n_paragraphs):
+    """CoreNLP output (as a list of lines) for the sample paragraph repeated
+    n_paragraphs times, with coreferences for each paragraph."""
+    out = []
+    offset = 0
+    for i in range(n_paragraphs):
+        for j, sentence in enumerate(SENTENCES):
+            # offsets are not realistic, but they vary
+            offsets = range(offset, offset + 12)
+            out.append(sentence.format(2 * i + j + 1, *offsets))
+            offset += 50
+    for i in range(n_paragraphs):
+        out.append(COREFERENCE.replace("(1,", "(%d," % (2 * i + 1))
+                              .replace("(2,", "(%d," % (2 * i + 2)))
+    return "".join(out).split("\n")
+
+
+if __name__ == "__main__":
+    print("%10s %10s %12s %12s" % ("sentences", "lines", "seconds",
+                                   "tokens/s"))
+    for n in [1, 10, 100, 1000, 10000]:
+        lines = corenlp_output(n)
+        repeat = max(1, 1000 // n)
+        start = timer()
+        for _ in range(repeat):
+            saf = stanford_to_saf(lines)
+        elapsed = (timer() - start) / repeat
+        print("%10d %10d %12.6f %12.0f" % (2 * n, len(lines), elapsed,
+                                           len(saf['tokens']) / elapsed))
@@ -23,6 +23,66 @@ ELASTICSEARCH = [
     # add more hosts here
 ]
 
+# To tune the per-process client, use a dict instead, e.g.:
+#ELASTICSEARCH = dict(
+#    hosts=[{"host": "localhost", "port": 9200}],
+#    maxsize=10,             # connections kept open per host
+#    timeout=30,             # seconds
+#    max_retries=3,
+#    retry_on_timeout=True,
+#)
+
+# Cache for results of tasks and pipelines on plain-text input, keyed by the
+# hash of the text. Disabled by default; to enable, use e.g.:
+#RESULT_CACHE = dict(
+#    lru_size=1000,          # results kept in each process
+#    backend='sqlite',       # shared SQLite file; None for in-process only
+#    path=None,              # default: XTAS_DATA/result_cache.sqlite
+#    max_size=1000000,       # results kept in the SQLite file
+#    ttl=None,               # seconds to keep results; None for no expiry
+#)
+RESULT_CACHE = None
+
+# CoreNLP processes kept running by each worker process, per set of
+# annotators. processes=None means as many as there are CPU cores and as
+# fit in the available memory.
+CORENLP = dict(
+    processes=None,
+    memory="3G",            # Java heap size per process
+)
+
+# Semafor processes kept running by each worker process.
+SEMAFOR = dict(
+    processes=1,
+    memory="4g",            # Java heap size per process
+)
+
+# Stanford NER servers kept running by each worker process.
+STANFORD_NER = dict(
+    processes=1,
+    memory="1000m",         # Java heap size per process
+)
+
+# Frog servers, which should be started separately (frog -S <port>). Each
+# worker process spreads requests over these.
+FROG = dict(
+    endpoints=[("localhost", 9887)],    # (host, port) of each server
+    connections=2,          # connections per server, per worker process
+    persistent=False,       # True to reuse connections; needs EOT support
+    timeout=300,            # socket timeout in seconds
+    retry_interval=30,      # seconds to skip a server that can't be reached
+)
+
+# Resources loaded by each worker process when it starts, rather than by the
+# first task that needs them; the worker process takes tasks only when
+# they're loaded. Choose from 'nltk', 'sentiwords', 'polarity', 'corenlp',
+# 'semafor' and 'stanford_ner', e.g., resources=['semafor'] on workers
+# dedicated to Semafor, since loading its models takes a few minutes.
+WARMUP = dict(
+    resources=[],
+    timeout=600,            # seconds a worker process may take to start
+)
+
 # Additional modules to load in the worker and webserver.
 EXTRA_MODULES = [
 ]
@@ -1,7 +1,12 @@
 from collections import Sequence
+from functools import wraps
+import os
+import threading
 
 import nltk
 
+from .core import _config
+
 
 def nltk_download(package):
     # XXX we could set the download_dir to download to xtas_data/nltk_data
@@ -9,6 +14,91 @@ def nltk_download(package):
     nltk.download(package, raise_on_error=True, quiet=False)
 
 
+def _nltk_data(package, path):
+    """Download an NLTK data package if the resource at path (e.g.,
+    'corpora/wordnet') is not installed."""
+    try:
+        nltk.data.find(path)
+    except LookupError:
+        nltk_download(package)
+
+
+def _lemmatizer():
+    _nltk_data('wordnet', 'corpora/wordnet')
+    lemmatizer = nltk.WordNetLemmatizer()
+    lemmatizer.lemmatize('cats')    # WordNet is loaded lazily
+    return lemmatizer
+
+
+def _pos_tagger():
+    try:
+        # NLTK >= 3.1 tags with the averaged perceptron, loading it anew
+        # on each call to nltk.pos_tag.
+        from nltk.tag import PerceptronTagger
+    except ImportError:
+        _nltk_data('maxent_treebank_pos_tagger',
+                   'taggers/maxent_treebank_pos_tagger')
+        return nltk.data.load(
+            'taggers/maxent_treebank_pos_tagger/english.pickle')
+    _nltk_data('averaged_perceptron_tagger',
+               'taggers/averaged_perceptron_tagger')
+    return PerceptronTagger()
+
+
+# Name : function that loads the resource.
+_NLTK_LOADERS = {
+    'lemmatizer': _lemmatizer,
+    'pos_tagger': _pos_tagger,
+}
+
+_nltk_resources = {}
+_nltk_lock = threading.Lock()
+
+
+def nltk_resource(name):
+    """Get an NLTK object ('lemmatizer' or 'pos_tagger').
+
+    Each object is loaded, after downloading its data if necessary, once per
+    process; later calls don't touch the downloader or the disk.
+    """
+    try:
+        return _nltk_resources[name]
+    except KeyError:
+        with _nltk_lock:
+            if name not in _nltk_resources:
+                _nltk_resources[name] = _NLTK_LOADERS[name]()
+            return _nltk_resources[name]
+
+
+def per_process(config_key):
+    """Decorator for a function that constructs an object, such as a client
+    with open connections, from the configuration under config_key (see
+    xtas.core.configure; None if not set).
+
+    The decorated function takes no arguments and returns the object for
+    the current process: it is constructed on first use and reused
+    afterwards, and rebuilt when the configuration is replaced and in a
+    forked child (such as a Celery prefork worker), since connections must
+    not be shared between processes.
+    """
+    def decorator(factory):
+        lock = threading.Lock()
+        state = {}
+
+        @wraps(factory)
+        def get():
+            config = _config.get(config_key)
+            pid = os.getpid()
+            with lock:
+                if state.get('pid') != pid or state['config'] is not config:
+                    state['value'] = factory(config)
+                    state['config'] = config
+                    state['pid'] = pid
+                return state['value']
+        return get
+    return decorator
+
+
 def tosequence(it):
     """Convert iterable it to a sequence if it isn't already one."""
     return it if isinstance(it, Sequence) else list(it)
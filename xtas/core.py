@@ -29,18 +29,60 @@ def configure(config, import_error="raise", unknown_key="raise"):
     Parameters
     ----------
     config : dict
-        Dict with keys ``CELERY``, ``ELASTICSEARCH`` and ``EXTRA_MODULES``
-        will be used to configure the xtas Celery app.
+        Dict with keys ``CELERY``, ``ELASTICSEARCH``, ``EXTRA_MODULES``,
+        ``RESULT_CACHE``, ``CORENLP``, ``SEMAFOR``, ``STANFORD_NER``,
+        ``FROG`` and ``WARMUP`` will be used to configure the xtas Celery app.
 
         ``config.CELERY`` will be passed to Celery's ``config_from_object``
         with the flag ``force=True``.
 
         ``ELASTICSEARCH`` should be a list of dicts with at least the key
         'host'. These are passed to the Elasticsearch constructor (from the
-        official client) unchanged.
+        official client) unchanged. Alternatively, it may be a dict with the
+        list of hosts under the key 'hosts' and further keyword arguments for
+        the constructor, e.g. 'maxsize' (connection pool size per host),
+        'timeout', 'max_retries' and 'retry_on_timeout'. One client is
+        created per process and reused across tasks.
 
         ``EXTRA_MODULES`` should be a list of module names to load.
 
+        ``RESULT_CACHE`` enables caching of results on plain-text input
+        (see ``xtas.tasks.cache``). It should be None (no caching) or a dict
+        with optional keys 'lru_size' (number of results kept in each
+        process), 'backend' ('sqlite' for an SQLite file shared by the
+        processes on a machine, None for no shared cache, or an object with
+        get and set methods), 'path' (of the SQLite file, by default
+        ``result_cache.sqlite`` in the xtas data directory), 'max_size'
+        (number of results kept in the SQLite file; the oldest are deleted
+        first) and 'ttl' (seconds after which results expire; None, the
+        default, for no expiry).
+
+        ``CORENLP`` should be a dict with optional keys 'processes' (maximum
+        number of CoreNLP processes per annotator set in each worker
+        process; by default, as many as there are CPU cores and as fit in
+        the available memory) and 'memory' (Java heap size per process).
+
+        ``SEMAFOR`` should be a dict with optional keys 'processes' (number
+        of Semafor processes in each worker process), 'memory' (Java heap
+        size per process).
+
+        ``STANFORD_NER`` configures the Stanford NER server processes in the
+        same way as ``SEMAFOR``.
+
+        ``FROG`` should be a dict with optional keys 'endpoints' (list of
+        (host, port) pairs of Frog servers), 'connections' (maximum number
+        of connections per server in each worker process), 'persistent'
+        (whether to keep connections open between requests; requires a
+        Frog version that supports the EOT marker; off by default),
+        'timeout' (socket timeout in seconds) and 'retry_interval'
+        (seconds for which a server that could not be reached is skipped).
+
+        ``WARMUP`` should be a dict with optional keys 'resources' (list of
+        resources to load when a worker process starts, out of 'nltk',
+        'sentiwords', 'polarity', 'corenlp', 'semafor' and 'stanford_ner')
+        and 'timeout' (seconds that starting a worker process, including
+        loading these, may take).
+
         Failure to supply ``CELERY`` or ``ELASTICSEARCH`` causes the default
         configuration to be re-set. Extra modules will not be unloaded,
         though.
@@ -55,7 +97,8 @@ def configure(config, import_error="raise", unknown_key="raise"):
         Either "log", "raise" or "ignore".
     """
 
-    members = {'CELERY', 'ELASTICSEARCH', 'EXTRA_MODULES'}
+    members = {'CELERY', 'ELASTICSEARCH', 'EXTRA_MODULES', 'RESULT_CACHE',
+               'CORENLP', 'SEMAFOR', 'STANFORD_NER', 'FROG', 'WARMUP'}
 
     if unknown_key != 'ignore':
         unknown_keys = set(config.keys()) - members
@@ -72,6 +115,15 @@ def configure(config, import_error="raise", unknown_key="raise"):
     _config['ELASTICSEARCH'] = es
     logger.info('Using Elasticsearch at %s' % es)
 
+    _config['RESULT_CACHE'] = config.get('RESULT_CACHE',
+                                         _defaultconfig.RESULT_CACHE)
+    _config['CORENLP'] = config.get('CORENLP', _defaultconfig.CORENLP)
+    _config['SEMAFOR'] = config.get('SEMAFOR', _defaultconfig.SEMAFOR)
+    _config['STANFORD_NER'] = config.get('STANFORD_NER',
+                                         _defaultconfig.STANFORD_NER)
+    _config['FROG'] = config.get('FROG', _defaultconfig.FROG)
+    _config['WARMUP'] = config.get('WARMUP', _defaultconfig.WARMUP)
+
     for m in config.get('EXTRA_MODULES', []):
         try:
             importlib.import_module(m)
@@ -1,3 +1,6 @@
+from .cache import *    # NOQA
 from .cluster import *  # NOQA
 from .es import *       # NOQA
+from .pipeline import run_fused  # NOQA
 from .single import *   # NOQA
+from . import _warmup   # NOQA  (connects the warm-up signal handlers)
@@ -8,20 +8,32 @@ The module needs the dependencies end_hook, which seems to be missing in the
 
 http://www.let.rug.nl/vannoord/alp/Alpino/binary/versions/Alpino-x86_64-linux-glibc2.5-20214.tar.gz
 
+The parser is kept running between calls (see AlpinoParser); the tokenizer
+is cheap to start and is run per call.
+
 See: http://www.let.rug.nl/vannoord/alp/Alpino
 """
 
 
+from collections import deque
+import itertools
 import subprocess
 import logging
 import os
 import datetime
+import threading
+
+from ._pool import kill_on_error
 
 log = logging.getLogger(__name__)
 
 CMD_PARSE = ["bin/Alpino", "end_hook=dependencies", "-parse"]
 CMD_TOKENIZE = ["Tokenization/tok"]
 
+# Sentence parsed after each request, to detect the end of its output.
+_END_SENTENCE = "Jan slaapt"
+_END_KEY = "xtas_end_{}"
+
 
 def parse_text(text):
     tokens = tokenize(text)
@@ -51,17 +63,95 @@ def tokenize(text):
     return tokens
 
 
+class AlpinoParser(object):
+    """
+    Resident Alpino parser process.
+
+    Alpino is started once and fed tokenized sentences over stdin, so its
+    startup and grammar loading costs are paid only once per process.
+    Each sentence is given a key, which the dependencies end_hook prints at
+    the end of its output lines. A request ends with a sentinel sentence
+    with a unique key; its first output line marks the end of the request's
+    output. If Alpino dies, it is restarted on the next request.
+    """
+
+    _singleton = None
+    _singleton_lock = threading.Lock()
+
+    @classmethod
+    def get_singleton(cls):
+        with cls._singleton_lock:
+            if cls._singleton is None:
+                cls._singleton = cls()
+            return cls._singleton
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = itertools.count()
+        self.start_alpino()
+
+    def start_alpino(self):
+        alpino_home = os.environ['ALPINO_HOME']
+        self.process = subprocess.Popen(CMD_PARSE, shell=False,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        cwd=alpino_home,
+                                        env={'ALPINO_HOME': alpino_home})
+        # Alpino is chatty on stderr; keep the tail for error messages, and
+        # keep reading so it doesn't block on a full pipe.
+        self.err_lines = deque(maxlen=20)
+        self.err_thread = threading.Thread(target=self.read_errors)
+        self.err_thread.daemon = True
+        self.err_thread.start()
+
+    def read_errors(self):
+        "intended to be run as background thread to collect stderr"
+        for line in iter(self.process.stderr.readline, ''):
+            self.err_lines.append(line)
+
+    def parse(self, tokens):
+        """
+        Parse tokenized sentences (one per line, tokens separated by spaces,
+        as returned by tokenize) and return the raw dependencies output.
+        """
+        sentences = [line for line in tokens.split("\n") if line.strip()]
+        with self.lock:
+            if self.process.poll() is not None:
+                log.warn("Alpino process died, respawning")
+                self.start_alpino()
+
+            end_key = _END_KEY.format(next(self.requests))
+            try:
+                # On any error, we don't know where we are in the output,
+                # so the process is killed and restarted on the next request.
+                with kill_on_error(self.process):
+                    for sid, sentence in enumerate(sentences, 1):
+                        self.process.stdin.write("%d|%s\n" % (sid, sentence))
+                    self.process.stdin.write("%s|%s\n"
+                                             % (end_key, _END_SENTENCE))
+                    self.process.stdin.flush()
+
+                    parse = []
+                    for line in iter(self.process.stdout.readline, ''):
+                        key = line.rstrip("\n").rsplit("|", 1)[-1]
+                        if key == end_key:
+                            break
+                        elif not key.startswith("xtas_end_"):
+                            # skip the rest of the previous request's
+                            # sentinel
+                            parse.append(line)
+                    else:
+                        raise IOError("Alpino exited unexpectedly")
+            except IOError:
+                err = "".join(self.err_lines)
+                raise Exception("Parse problem. Alpino died, "
+                                "error messages: {err!r}".format(**locals()))
+        return "".join(parse)
+
+
 def parse_raw(tokens):
-    alpino_home = os.environ['ALPINO_HOME']
-    p = subprocess.Popen(CMD_PARSE, shell=False,
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         cwd=alpino_home, env={'ALPINO_HOME': alpino_home})
-    parse, err = p.communicate(tokens)
-    if not parse:
-        raise Exception("Parse problem. Output was {parse!r}, "
-                        "error messages: {err!r}".format(**locals()))
-    return parse
+    return AlpinoParser.get_singleton().parse(tokens)
 
 
 def interpret_parse(parse):
@@ -4,7 +4,9 @@ Wrapper around the CoreNLP parser
 The module expects CORENLP_HOME to point to the CoreNLP installation dir.
 
 If run with all annotators, it requires around 3G of memory,
-and it will keep the process in memory indefinitely.
+and it will keep the process in memory indefinitely. Each worker process
+keeps a pool of CoreNLP processes per set of annotators, sized by the
+CORENLP configuration (see xtas.core.configure).
 
 See: http://nlp.stanford.edu/software/corenlp.shtml#Download
 
@@ -14,41 +16,60 @@ http://nlp.stanford.edu/software/stanford-corenlp-full-2014-01-04.zip
 
 
 import datetime
-from io import StringIO
-import itertools
+import errno
+import fcntl
 import logging
+import multiprocessing
 import os
 import os.path
 import re
+import select
 import subprocess
 import threading
-import time
 
 from six import iteritems
 
 from unidecode import unidecode
 
+from ..core import _config
+from ._pool import ProcessPool, kill_on_error
+
 log = logging.getLogger(__name__)
 
 _CORENLP_VERSION = None
 
 
-class StanfordCoreNLP(object):
+_PROMPT = "NLP> "
 
-    _singletons = {}  # annotators : object
+# Annotators run by the corenlp_lemmatize task; the corenlp task runs all.
+LEMMATIZE_ANNOTATORS = ("tokenize", "ssplit", "pos", "lemma")
+
+# Document that parse_many puts between documents. Parsed, it is a single
+# sentence, of which CoreNLP prints the text right after the header.
+_DOC_SEPARATOR = "xtasdocumentseparator"
+
+
+def _read_chunk(fd):
+    "Read what is available from non-blocking fd; '' at EOF, None if nothing"
+    try:
+        return os.read(fd, 65536)
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        raise
 
-    @classmethod
-    def get_singleton(cls, annotators=None, **options):
-        """
-        Get or create a corenlp parser with the given annotator and options
-        Note: multiple parsers with the same annotator and different options
-              are not supported.
-        """
-        if annotators is not None:
-            annotators = tuple(annotators)
-        if annotators not in cls._singletons:
-            cls._singletons[annotators] = cls(annotators, **options)
-        return cls._singletons[annotators]
+
+def _write_chunk(fd, data):
+    "Write what fits to non-blocking fd; returns the number of bytes written"
+    try:
+        return os.write(fd, data[:65536])
+    except OSError as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise
+
+
+class StanfordCoreNLP(object):
 
     def __init__(self, annotators=None, timeout=1000, memory="3G"):
         """
@@ -64,63 +85,222 @@ class StanfordCoreNLP(object):
         _CORENLP_VERSION = get_corenlp_version()
         self.start_corenlp()
 
+    def _command(self):
+        return get_command(memory=self.memory, annotators=self.annotators)
+
     def start_corenlp(self):
-        cmd = get_command(memory=self.memory, annotators=self.annotators)
-        self.corenlp_process = subprocess.Popen(cmd, shell=True,
+        self.corenlp_process = subprocess.Popen(self._command(), shell=True,
                                                 stdin=subprocess.PIPE,
                                                 stdout=subprocess.PIPE,
                                                 stderr=subprocess.PIPE)
+        for f in (self.corenlp_process.stdin, self.corenlp_process.stdout,
+                  self.corenlp_process.stderr):
+            flags = fcntl.fcntl(f, fcntl.F_GETFL)
+            fcntl.fcntl(f, fcntl.F_SETFL, flags | os.O_NONBLOCK)
         self.lock = threading.Lock()
-        self.out_lines = []
-        self.read_thread = threading.Thread(target=self.read_output_lines)
-        self.read_thread.daemon = True
-        self.read_thread.start()
         self.communicate(input=None)
 
-    def read_output_lines(self):
-        "intended to be run as background thread to collect parser output"
-        while True:
-            line = self.corenlp_process.stdout.readline()
-            if line == '':  # EOF
-                break
-            self.out_lines.append(line.strip())
-
     def communicate(self, input):
+        """
+        Send input, which should consist of whole lines, and return the
+        output lines.
+
+        CoreNLP prints a prompt on stderr before reading each line, blank
+        lines included, and the results for a line on stdout. The prompt
+        before the first line was read by the previous call, so after
+        sending n lines, we wait for n prompts; with input None, we wait
+        for the first prompt. Since stdout is flushed per line, all output
+        is in the pipe once the last prompt arrives. Input is written as
+        CoreNLP is ready to accept it, so large inputs cannot deadlock
+        against a full output pipe.
+        """
         if self.corenlp_process.poll() is not None:
             logging.warn("CoreNLP process died, respawning")
             self.start_corenlp()
-        with self.lock:
-            self.out_lines = []
-
-            if input:
-                self.corenlp_process.stdin.write(input)
-                self.corenlp_process.stdin.write("\n\n")
-                self.corenlp_process.stdin.flush()
-
-            # wait until we get a prompt
-            err_buffer = StringIO()
+        # On any error, such as a time limit, we don't know where we are in
+        # the output, so the process is killed and respawned next time.
+        with self.lock, kill_on_error(self.corenlp_process):
+            pending = input or ""
+            prompts = pending.count("\n") if input is not None else 1
+
+            in_fd = self.corenlp_process.stdin.fileno()
+            out_fd = self.corenlp_process.stdout.fileno()
+            err_fd = self.corenlp_process.stderr.fileno()
+            out, err = [], ""
+            while prompts > 0:
+                readable, writable, _ = select.select(
+                    [out_fd, err_fd], [in_fd] if pending else [], [])
+                if writable:
+                    pending = pending[_write_chunk(in_fd, pending):]
+                for fd in readable:
+                    chunk = _read_chunk(fd)
+                    if chunk is None:   # spurious wakeup
+                        continue
+                    if not chunk:       # EOF
+                        raise Exception("CoreNLP process died, error output:"
+                                        " {err!r}".format(**locals()))
+                    if fd == out_fd:
+                        out.append(chunk)
+                    else:
+                        # Count prompts in the new chunk, plus the end of the
+                        # previous one in case a prompt was split.
+                        err = err[-(len(_PROMPT) - 1):] + chunk
+                        prompts -= err.count(_PROMPT)
+            # drain remaining output
             while True:
-                err_buffer.write(self.corenlp_process.stderr.read(1))
-                err_buffer.seek(-5, 2)
-                if err_buffer.read() == "NLP> ":
+                chunk = _read_chunk(out_fd)
+                if not chunk:
                     break
+                out.append(chunk)
 
-        # give stdout a chance to flush
-        # is there a better way to do this?
-        time.sleep(.1)
-        return self.out_lines
+        out = "".join(out)
+        if not out:
+            return []
+        if out.endswith("\n"):
+            out = out[:-1]
+        return [line.strip() for line in out.split("\n")]
 
     def parse(self, text):
         """Call the server and return the raw results."""
-        if isinstance(text, bytes):
-            text = text.decode("ascii")
-        text = re.sub("\s+", " ", unidecode(text))
-        return self.communicate(text + "\n")
+        return self.communicate(_clean_text(text) + "\n")
+
+    def parse_many(self, texts):
+        """
+        Parse multiple documents in one interaction with the server.
+
+        Each document is followed by a separator document, which is used to
+        split the output. Returns a list with the raw results per document.
+        """
+        texts = [_clean_text(text) for text in texts]
+        input = "".join("%s\n%s\n" % (text, _DOC_SEPARATOR)
+                        for text in texts)
+        results = _split_documents(self.communicate(input))
+        if len(results) != len(texts):
+            raise Exception("Expected CoreNLP output for {} documents, got {}"
+                            .format(len(texts), len(results)))
+        return results
+
+
+def _clean_text(text):
+    if isinstance(text, bytes):
+        text = text.decode("ascii")
+    return re.sub("\s+", " ", unidecode(text))
+
+
+def _split_documents(lines):
+    """
+    Split the output of parse_many into the output for each document,
+    dropping the output for the separators.
+    """
+    docs = []
+    current = []
+    in_separator = False
+    for i, line in enumerate(lines):
+        if (line.startswith("Sentence #") and i + 1 < len(lines)
+                and lines[i + 1] == _DOC_SEPARATOR):
+            docs.append(current)
+            current = []
+            in_separator = True
+        elif in_separator and line.startswith("Sentence #"):
+            in_separator = False
+        if not in_separator:
+            current.append(line)
+    return docs
+
+
+class CoreNLPPool(ProcessPool):
+    """
+    Bounded pool of CoreNLP processes with the same annotators.
+    See ProcessPool.
+    """
+
+    name = "CoreNLP"
+
+    _pools = {}  # annotators : pool
+    _pools_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, annotators=None, **options):
+        """
+        Get or create the pool for the given annotators and options.
+        The pool size and Java heap size are taken from the CORENLP config
+        unless given as the options size and memory.
+        """
+        if annotators is not None:
+            annotators = tuple(annotators)
+        with cls._pools_lock:
+            if annotators not in cls._pools:
+                config = _config.get('CORENLP', {})
+                options.setdefault('memory', config.get('memory', "3G"))
+                if 'size' not in options:
+                    options['size'] = (config.get('processes')
+                                       or _default_pool_size(
+                                           options['memory']))
+                cls._pools[annotators] = cls(annotators, **options)
+            return cls._pools[annotators]
+
+    def __init__(self, annotators=None, size=1, **options):
+        super(CoreNLPPool, self).__init__(size)
+        self.annotators = annotators
+        self.options = options
+
+    def _start_process(self):
+        return StanfordCoreNLP(self.annotators, **self.options)
+
+    def _is_alive(self, process):
+        return process.corenlp_process.poll() is None
+
+    def _restart(self, process):
+        process.start_corenlp()
+
+
+def _parse_memory(memory):
+    "Convert a Java heap size such as '3G' or '512m' to bytes"
+    units = {'k': 2 ** 10, 'm': 2 ** 20, 'g': 2 ** 30}
+    memory = str(memory).lower()
+    if memory[-1] in units:
+        return int(memory[:-1]) * units[memory[-1]]
+    return int(memory)
+
+
+def _available_memory():
+    "Return the available memory in bytes, or None if unknown"
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def _default_pool_size(memory):
+    """
+    Number of CoreNLP processes to run: one per CPU core, limited by the
+    available memory given the per-process heap size.
+    """
+    size = multiprocessing.cpu_count()
+    available = _available_memory()
+    if available is not None:
+        size = min(size, available // _parse_memory(memory))
+    return max(1, size)
 
 
 def parse(text, annotators=None, **options):
-    s = StanfordCoreNLP.get_singleton(annotators, **options)
-    return s.parse(text, **options)
+    pool = CoreNLPPool.get(annotators, **options)
+    with pool.process() as s:
+        return s.parse(text)
+
+
+def parse_many(texts, annotators=None, **options):
+    """
+    Parse many (short) documents in one interaction with a CoreNLP process.
+    Returns a list of raw results, one per document.
+    """
+    pool = CoreNLPPool.get(annotators, **options)
+    with pool.process() as s:
+        return s.parse_many(texts)
 
 
 def get_corenlp_version():
@@ -148,11 +328,24 @@ def get_command(annotators=None, memory=None):
     return cmd
 
 
+# States of the stanford_to_saf parser: what the next line should be.
+_SENTENCE, _TEXT, _TOKENS, _TREE, _DEPENDENCIES, _COREFERENCES = range(6)
+
+_RE_SENTENCE = re.compile(r"Sentence #\s*(\d+)\s+")
+_RE_TOKEN = re.compile(r"\[([^\]]+)\]")
+_RE_INT = re.compile(r"\d+")
+
+
 def stanford_to_saf(lines):
     """
     Convert stanfords 'interactive' text format to saf
     Unfortunately, stanford cannot return xml in interactive mode, so we
     need to parse their plain text format
+
+    The output is parsed in a single pass over the lines, as a sequence of
+    sentences, each consisting of a header, the text, the tokens, and
+    optionally a tree and dependencies (both terminated by a blank line),
+    followed by the coreference sets.
     """
     processed = {'module': "corenlp",
                  'module-version': _CORENLP_VERSION,
@@ -160,97 +353,103 @@ def stanford_to_saf(lines):
     saf = {'header': {'format': "SAF",
                       'format-version': "0.0",
                       'processed': [processed]},
+           'tokens': [],
            'trees': [],
            'dependencies': [],
            'coreferences': [],
            'entities': []
            }
-    tokens = {}  # sentence_no, index -> token
-
-    def _regroups(pattern, text, **kargs):
-        m = re.match(pattern, text, **kargs)
-        if not m:
-            raise Exception("Pattern {pattern!r} did not match text {text!r}"
-                            .format(**locals()))
-        return m.groups()
-
-    while True:  # parse one sentence
-        # skip leading blanks
-        lines = itertools.dropwhile(lambda x: not x, lines)
-        try:
-            line = lines.next()
-        except StopIteration:
-            break  # done!
-        if line == "Coreference set:":
-            break  # skip to corefs
-        sentence_no = int(_regroups("Sentence #\s*(\d+)\s+", line)[0])
-        text = lines.next()
-
-        log.debug("Parsing sentence {sentence_no}: {text!r}"
-                  .format(**locals()))
-
-        # Parse tokens
-        for i, s in enumerate(re.findall('\[([^\]]+)\]', lines.next())):
-            wd = dict(re.findall(r"([^=\s]*)=([^=\s]*)", s))
-            tokenid = len(tokens) + 1
-            token = dict(id=tokenid, word=wd['Text'], lemma=wd['Lemma'],
-                         pos=wd['PartOfSpeech'], sentence=sentence_no,
-                         offset=wd["CharacterOffsetBegin"])
-            token['pos1'] = POSMAP[token['pos']]
-            tokens[sentence_no, i] = token
-            if wd.get('NamedEntityTag', 'O') != 'O':
-                saf['entities'].append(dict(tokens=[tokenid],
-                                            type=wd['NamedEntityTag']))
-        # try to peek ahead to see if we have more than tokens
-        lines, copy = itertools.tee(lines)
-        try:
-            peek = copy.next()
-            if peek.startswith("Sentence #"):
-                continue  # no tree/dependencies, skip to next sentence
-        except StopIteration:
-            break  # done!
-
-        # Extract original tree
-        tree = " ".join(itertools.takewhile(lambda x: x, lines))
-        saf['trees'].append(dict(sentence=sentence_no, tree=tree))
-
-        def parse_dependency(line):
+    tokens = {}  # sentence_no, index -> token id
+    tree = []
+    state = _SENTENCE
+
+    for line in lines:
+        if state == _TEXT:
+            log.debug("Parsing sentence %d: %r", sentence_no, line)
+            state = _TOKENS
+        elif state == _TOKENS:
+            _parse_tokens(line, sentence_no, tokens, saf)
+            state = _TREE
+        elif state == _COREFERENCES:
+            if line and line != "Coreference set:":
+                saf['coreferences'].append(_parse_coreference(line, tokens))
+        elif not line:
+            # A blank line ends the tree, then the dependencies.
+            if tree:
+                saf['trees'].append(dict(sentence=sentence_no,
+                                         tree=" ".join(tree)))
+                tree = []
+                state = _DEPENDENCIES
+            elif state == _DEPENDENCIES:
+                state = _SENTENCE
+        elif line.startswith("Sentence #"):
+            sentence_no = int(_regroups(_RE_SENTENCE, line)[0])
+            state = _TEXT
+        elif line == "Coreference set:":
+            state = _COREFERENCES
+        elif state == _TREE:
+            tree.append(line)
+        elif state == _DEPENDENCIES:
             rfunc, parent, child = _regroups(RE_DEPENDENCY, line)
             if rfunc != 'root':
-                parent, child = [tokens[sentence_no, int(j)-1]['id']
-                                 for j in (parent, child)]
-                saf['dependencies'].append(dict(child=child, parent=parent,
-                                                relation=rfunc))
-        # parse dependencies until blank line
-        map(parse_dependency, itertools.takewhile(lambda x: x, lines))
-
-    # get coreferences
-    def get_coreference(lines):
-        for line in itertools.takewhile(lambda l: l != "Coreference set:",
-                                        lines):
-            if line.strip():
-                groups = _regroups(RE_COREF, line)
-                yield [map(int, re.sub("[^\\d,]", "", s).split(","))
-                       for s in groups]
-    while True:
-        corefs = list(get_coreference(lines))
-        if not corefs:
-            break
-        for coref in corefs:
-            sets = []
-            for sent_index, head_index, from_index, to_index in coref:
-                # take all nodes from .. to, place head first (False<True)
-                indices = sorted(range(from_index, to_index),
-                                 key=lambda i: (i != head_index, i))
-                sets.append([tokens[sent_index, i-1]['id'] for i in indices])
-            saf['coreferences'].append(sets)
-
-    # add tokens and drop empty placeholders
-    saf['tokens'] = tokens.values()
+                saf['dependencies'].append(dict(
+                    child=tokens[sentence_no, _node_index(child)],
+                    parent=tokens[sentence_no, _node_index(parent)],
+                    relation=rfunc))
+        else:
+            raise Exception("Unexpected line in CoreNLP output: {line!r}"
+                            .format(**locals()))
+
+    # drop empty placeholders
     return {k: v for (k, v) in iteritems(saf) if v}
 
-RE_DEPENDENCY = "(\w+)\(.+-([0-9']+), .+-([0-9']+)\)"
-RE_COREF = r'\s*\((\S+)\) -> \((\S+)\), that is: \".*\" -> \".*\"'
+
+def _regroups(pattern, text):
+    m = pattern.match(text)
+    if not m:
+        raise Exception("Pattern {pattern.pattern!r} did not match text "
+                        "{text!r}".format(**locals()))
+    return m.groups()
+
+
+def _parse_tokens(line, sentence_no, tokens, saf):
+    "Add the tokens (and entities) on a line of CoreNLP output to saf"
+    for i, s in enumerate(_RE_TOKEN.findall(line)):
+        wd = dict(kv.split("=", 1) for kv in s.split() if "=" in kv)
+        tokenid = len(saf['tokens']) + 1
+        pos = wd['PartOfSpeech']
+        saf['tokens'].append(dict(id=tokenid, word=wd['Text'],
+                                  lemma=wd['Lemma'], pos=pos,
+                                  pos1=POSMAP[pos], sentence=sentence_no,
+                                  offset=wd["CharacterOffsetBegin"]))
+        tokens[sentence_no, i] = tokenid
+        ne = wd.get('NamedEntityTag', 'O')
+        if ne != 'O':
+            saf['entities'].append(dict(tokens=[tokenid], type=ne))
+
+
+def _node_index(node):
+    "Zero-based token index of a dependency node, e.g. 3 or 3' (a copy)"
+    return int(node.rstrip("'")) - 1
+
+
+def _parse_coreference(line, tokens):
+    """
+    Parse a line of a CoreNLP coreference set into a pair of lists of token
+    ids, with the head of each mention first
+    """
+    mentions = []
+    for mention in _regroups(RE_COREF, line):
+        sent_index, head_index, from_index, to_index = map(
+            int, _RE_INT.findall(mention))
+        # take all nodes from .. to, place head first (False<True)
+        indices = sorted(range(from_index, to_index),
+                         key=lambda i: (i != head_index, i))
+        mentions.append([tokens[sent_index, i-1] for i in indices])
+    return mentions
+
+RE_DEPENDENCY = re.compile(r"(\w+)\(.+-([0-9']+), .+-([0-9']+)\)")
+RE_COREF = re.compile(r'\s*\((\S+)\) -> \((\S+)\), that is: \".*\" -> \".*\"')
 POSMAP = {'CC': 'C',
           'CD': 'Q',
           'DT': 'D',
@@ -1,7 +1,11 @@
 """
 Wrapper around the ILK Frog lemmatizer/POS tagger
 
-The module expects frog to be running in server mode at localhost:9887
+The module expects frog to be running in server mode, by default at
+localhost:9887. Other and multiple servers can be configured with FROG (see
+xtas.core.configure); each worker process spreads requests over the
+servers that are up. With persistent=True, for Frog versions that support
+the EOT marker, connections are kept open between requests.
 
 Currently, the module is only tested with all frog modules active except for
 the NER and parser.
@@ -13,11 +17,20 @@ frog -S 9887
 See: http://ilk.uvt.nl/frog/
 """
 
-from unidecode import unidecode
-import socket
-from StringIO import StringIO
-from itertools import takewhile
+from contextlib import contextmanager
 import datetime
+import logging
+import select
+import socket
+import threading
+import time
+
+from unidecode import unidecode
+
+from .._utils import per_process
+from ._pool import ProcessPool
+
+log = logging.getLogger(__name__)
 
 FROG_HOST = "localhost"
 FROG_PORT = 9887
@@ -39,34 +52,241 @@ _POSMAP = {"VZ": "P",
            }
 
 
-def call_frog(text):
+class FrogConnection(object):
+    """
+    Connection to a Frog server.
+
+    Frog ends its output for a request with a line "READY". If persistent,
+    a request ends with a line "EOT" and the connection is kept open for the
+    next one; otherwise (for Frog versions that don't support this), the
+    client closes its end of the connection after each request.
+
+    The connection is made on the first request.
+    """
+
+    def __init__(self, address, persistent=False, timeout=300):
+        self.address = address
+        self.persistent = persistent
+        self.timeout = timeout
+        self.sock = None
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.file = self.sock.makefile('r')
+
+    def close(self):
+        if self.sock is not None:
+            for f in (self.file, self.sock):
+                try:
+                    f.close()
+                except socket.error:
+                    pass
+            self.sock = None
+
+    def is_stale(self):
+        "Whether the server closed this (idle) connection"
+        if self.sock is None:
+            return False
+        # An idle connection only becomes readable at EOF.
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+    def send(self, texts):
+        """
+        Send requests for texts (byte strings ending in a newline).
+        Only a persistent connection can take multiple requests.
+        """
+        if self.persistent:
+            for text in texts:
+                self.sock.sendall(text + "EOT\n")
+        else:
+            text, = texts
+            self.sock.sendall(text)
+            self.sock.shutdown(socket.SHUT_WR)
+
+    def read(self):
+        "Generate the output lines for the next request"
+        for line in self.file:
+            line = line.rstrip('\r\n')
+            if line == "READY":
+                return
+            yield line
+        raise socket.error("Frog server at %s:%d closed the connection"
+                           % self.address)
+
+
+class _FrogServer(ProcessPool):
     """
-    Call the frog parser on the given host and port with the given text
-    Returns a file object containing the output lines.
+    Pool of connections to one Frog server, which is skipped for
+    retry_interval seconds after a connection to it failed.
     """
+
+    name = "Frog connection"
+
+    def __init__(self, address, size, persistent, timeout, retry_interval):
+        super(_FrogServer, self).__init__(size)
+        self.address = address
+        self.persistent = persistent
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.down_until = 0
+
+    def _start_process(self):
+        return FrogConnection(self.address, self.persistent, self.timeout)
+
+    def _is_alive(self, conn):
+        return not conn.is_stale()
+
+    def _restart(self, conn):
+        # Reconnecting is done by FrogManager, which handles failures.
+        conn.close()
+
+    def mark_down(self):
+        log.warn("Cannot connect to Frog at %s:%d, skipping it for %d seconds",
+                 self.address[0], self.address[1], self.retry_interval)
+        self.down_until = time.time() + self.retry_interval
+
+    def is_up(self):
+        return self.down_until <= time.time()
+
+
+class FrogManager(object):
+    """
+    Connections to one or more Frog servers.
+
+    Each request is sent to the server with the fewest requests in progress
+    among those that are up; a server is considered down for a while after
+    a connection to it failed (the request is then sent to another server).
+    Idle persistent connections closed by the server are detected and
+    reopened.
+    """
+
+    def __init__(self, endpoints, connections=2, persistent=False,
+                 timeout=300, retry_interval=30):
+        self.persistent = persistent
+        self.servers = [_FrogServer((host, port), connections, persistent,
+                                    timeout, retry_interval)
+                        for host, port in endpoints]
+
+    def _choose(self, exclude):
+        candidates = [s for s in self.servers if s not in exclude]
+        up = [s for s in candidates if s.is_up()]
+        # If all remaining servers are down, try one anyway.
+        return min(up or candidates, key=lambda s: s.load())
+
+    @contextmanager
+    def connection(self):
+        "Context manager that gives a connected FrogConnection"
+        tried = []
+        while True:
+            server = self._choose(tried)
+            conn = server.checkout()
+            if conn.sock is None:
+                try:
+                    conn.connect()
+                except socket.error:
+                    server.checkin(conn)
+                    server.mark_down()
+                    tried.append(server)
+                    if len(tried) == len(self.servers):
+                        raise
+                    continue
+                if server.down_until:
+                    log.info("Frog at %s:%d is back up", *server.address)
+                    server.down_until = 0
+            break
+        try:
+            yield conn
+        except:
+            # The connection may be halfway a request, so don't reuse it.
+            conn.close()
+            raise
+        finally:
+            if not conn.persistent:
+                conn.close()
+            server.checkin(conn)
+
+
+@per_process('FROG')
+def _manager(config):
+    "Return the FrogManager for the current process"
+    options = dict(config or {})
+    endpoints = options.pop('endpoints', None) or [(FROG_HOST, FROG_PORT)]
+    return FrogManager(endpoints, **options)
+
+
+def _prepare(text):
+    "Convert text to what the Frog server expects"
     if not text.endswith("\n"):
         text = text + "\n"
     if not isinstance(text, unicode):
         text = unicode(text)
-    text = unidecode(text).encode("utf-8")
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((FROG_HOST, FROG_PORT))
-    s.sendall(text)
-    s.shutdown(socket.SHUT_WR)
-    for line in s.makefile('r'):
-        line = line.strip('\n')
-        if line == "READY":
-            return
-        else:
+    return unidecode(text).encode("utf-8")
+
+
+def call_frog(text):
+    """
+    Call the frog parser with the given text
+    Generates the output lines.
+    """
+    return _call(_manager(), _prepare(text))
+
+
+def _call(manager, text):
+    with manager.connection() as conn:
+        conn.send([text])
+        for line in conn.read():
             yield line
 
 
+def call_frog_many(texts):
+    """
+    Call the frog parser with each of the given texts.
+    Returns a list with the output lines for each text.
+
+    On a persistent connection, the requests are sent (by a separate
+    thread) without waiting for the output of the previous one.
+    """
+    texts = [_prepare(text) for text in texts]
+    manager = _manager()
+    if not manager.persistent:
+        return [list(_call(manager, text)) for text in texts]
+    if not texts:
+        return []
+    with manager.connection() as conn:
+        writer = threading.Thread(target=_send, args=(conn, texts))
+        writer.daemon = True
+        writer.start()
+        return [list(conn.read()) for _ in texts]
+
+
+def _send(conn, texts):
+    try:
+        conn.send(texts)
+    except socket.error:
+        # Reading will fail, too.
+        log.exception("Could not send to Frog at %s:%d", *conn.address)
+
+
+def _parse_line(line):
+    """
+    Parse a token line of frog output into
+    (word, lemma, pos, pos_confidence, ne, head, relation)
+    ne is None outside named entities; head is the index of the parent in
+    the sentence (-1 for the root).
+    """
+    _, word, lemma, _, pos, conf, ne, _, parent, rel = line.split("\t")
+    # NER label from BIO tags
+    ne = None if ne == 'O' else ne.split('_', 1)[0][2:]
+    return word, lemma, pos, float(conf), ne, int(parent) - 1, rel
+
+
 def parse_frog(lines):
     """
     Interpret the output of the frog parser.
     Input should be a sequence of lines (i.e. the output of call_frog)
-    Result is a sequence of dicts representing the tokens
+    Result is a sequence of dicts representing the tokens, generated as the
+    lines come in
     """
     sid = 0
     for i, l in enumerate(lines):
@@ -74,17 +294,54 @@ def parse_frog(lines):
             # end of sentence marker
             sid += 1
         else:
-            print(l.strip())
-            parts = l.split("\t")
-            tid, token, lemma, morph, pos, conf, ne, _, parent, rel = parts
-            r = dict(id=i, sentence=sid, word=token, lemma=lemma,
-                     pos=pos, pos_confidence=float(conf),
-                     rel=(rel, int(parent) - 1))
-            if ne != 'O':
-                r["ne"] = ne.split('_', 1)[0][2:]   # NER label from BIO tags
+            word, lemma, pos, conf, ne, head, rel = _parse_line(l)
+            r = dict(id=i, sentence=sid, word=word, lemma=lemma,
+                     pos=pos, pos_confidence=conf, rel=(rel, head))
+            if ne is not None:
+                r["ne"] = ne
             yield r
 
 
+TABLE_COLUMNS = ('word', 'lemma', 'pos', 'pos_confidence', 'ne', 'head',
+                 'relation', 'sentence')
+
+
+def frog_to_table(lines):
+    """
+    Interpret the output of the frog parser as a token table: a dict with
+    a list (column) for each of TABLE_COLUMNS, with one element per token.
+    This is much more compact than the output of parse_frog.
+    Input should be a sequence of lines (i.e. the output of call_frog).
+    """
+    columns = [[] for _ in TABLE_COLUMNS]
+    sentences = columns[-1]
+    appends = [column.append for column in columns[:-1]]
+    sid = 0
+    for l in lines:
+        if not l:
+            # end of sentence marker
+            sid += 1
+        else:
+            for append, value in zip(appends, _parse_line(l)):
+                append(value)
+            sentences.append(sid)
+    return dict(zip(TABLE_COLUMNS, columns))
+
+
+def convert(lines, output):
+    """
+    Convert frog output lines to the given output format; see the frog task.
+    """
+    if output == 'raw':
+        return list(lines)
+    elif output == 'table':
+        return frog_to_table(lines)
+    tokens = parse_frog(lines)
+    if output == 'tokens':
+        return list(tokens)
+    return frog_to_saf(tokens)
+
+
 def add_pos1(token):
     """
     Adds a 'pos1' element to a frog token.
@@ -96,7 +353,7 @@ def add_pos1(token):
 
 def frog_to_saf(tokens):
     """
-    Convert frog tokens into a new SAF document
+    Convert frog tokens (a sequence of dicts) into a new SAF document
     """
     tokens = [add_pos1(token) for token in tokens]
     module = {'module': "frog",
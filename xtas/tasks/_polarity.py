@@ -1,11 +1,24 @@
+"""
+Movie review polarity classifier.
+
+The model is trained by an explicit build step, which should be run once on
+each machine (or shared XTAS_DATA directory) before workers use it:
+
+    python -m xtas.tasks._polarity [--param-search]
+"""
+
 import errno
+import json
+import os
 import os.path
 from pprint import pprint
+import shutil
 import tarfile
-from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp, NamedTemporaryFile
 
 from six.moves.urllib.request import urlretrieve
 
+import sklearn
 from sklearn.datasets import load_files
 from sklearn.externals.joblib import dump, load
 from sklearn.feature_extraction.text import TfidfVectorizer
@@ -18,6 +31,9 @@ from .._downloader import _make_data_home, _progress
 
 MODEL = None
 
+# Change when the way the model is stored changes.
+_FORMAT_VERSION = 1
+
 
 TRAINING_DATA = (
     'http://www.cs.cornell.edu/people/pabo/movie-review-data'
@@ -76,18 +92,115 @@ def train(param_search=False):
         return clf.fit(data.data, y)
 
 
-def classify(doc):
+def _model_path():
+    """Directory for the model artifact; the format version is part of the
+    name, so a new version of xtas never picks up an old model."""
+    return os.path.join(_make_data_home("movie_reviews"),
+                        "model-v%d" % _FORMAT_VERSION)
+
+
+def build(param_search=False):
+    """Train the model and store it in the xtas data directory.
+
+    The model is stored uncompressed, so that get_model can memory-map its
+    arrays, along with a small metadata file for checking it at load time.
+    Returns the path to the model directory.
+    """
+    model = train(param_search)
+    path = _model_path()
+
+    # Write to a new directory, then atomically replace the symlink at path
+    # with one to that directory, so that workers never see a partial or
+    # missing model.
+    directory = mkdtemp(prefix=os.path.basename(path) + "-",
+                        dir=os.path.dirname(path))
+    try:
+        os.chmod(directory, 0o755)
+        model_file = os.path.join(directory, "model.pkl")
+        dump(model, model_file)
+        meta = {"version": _FORMAT_VERSION,
+                "sklearn_version": sklearn.__version__,
+                "files": {name: os.path.getsize(os.path.join(directory, name))
+                          for name in os.listdir(directory)}}
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        old = os.path.realpath(path) if os.path.islink(path) else None
+        if old is None and os.path.isdir(path):
+            # Not a symlink: stored by an older version of xtas.
+            shutil.rmtree(path)
+        link = directory + ".link"
+        os.symlink(os.path.basename(directory), link)
+        try:
+            os.rename(link, path)
+        except OSError:
+            os.remove(link)
+            raise
+    except:
+        shutil.rmtree(directory)
+        raise
+
+    if old is not None and os.path.isdir(old):
+        shutil.rmtree(old)
+    return path
+
+
+def _check(path):
+    """Check the metadata and file sizes of the model at path."""
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        raise IOError("No movie review polarity model at %r; build it with"
+                      " 'python -m xtas.tasks._polarity'" % path)
+
+    if meta.get("version") != _FORMAT_VERSION:
+        raise IOError("Movie review polarity model at %r has version %r,"
+                      " expected %d; rebuild it"
+                      % (path, meta.get("version"), _FORMAT_VERSION))
+    if meta.get("sklearn_version") != sklearn.__version__:
+        raise IOError("Movie review polarity model at %r was built with"
+                      " scikit-learn %s, but %s is installed; rebuild it"
+                      % (path, meta.get("sklearn_version"),
+                         sklearn.__version__))
+    for name, size in meta["files"].items():
+        filename = os.path.join(path, name)
+        if not os.path.exists(filename) or os.path.getsize(filename) != size:
+            raise IOError("Movie review polarity model file %r is missing or"
+                          " corrupt; rebuild the model" % filename)
+
+
+def get_model():
+    """Load the model built by build.
+
+    Its arrays are memory-mapped, so they are shared by all worker processes
+    on a machine.
+    """
     global MODEL
     if MODEL is None:
-        model_path = os.path.join(_make_data_home("movie_reviews"),
-                                  "classifier")
-        try:
-            MODEL = load(model_path)
-        except (IOError, OSError) as e:
-            if e.errno == errno.ENOENT:
-                MODEL = train()
-                dump(MODEL, model_path, compress=9)
-            else:
-                raise
-
-    return MODEL.predict_proba(doc)[0, 1]   # first sample, second class
+        path = _model_path()
+        _check(path)
+        MODEL = load(os.path.join(path, "model.pkl"), mmap_mode='r')
+    return MODEL
+
+
+def classify_many(docs):
+    """Probability that each of docs (a list of strings) is positive, as
+    an array; the documents are vectorized and classified in one go."""
+    return get_model().predict_proba(docs)[:, 1]    # second class
+
+
+def classify(doc):
+    return classify_many([doc])[0]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the movie review polarity model.")
+    parser.add_argument('--param-search', action='store_true',
+                        help="tune hyperparameters by cross-validation")
+    args = parser.parse_args()
+    print("Built model at %r" % build(args.param_search))
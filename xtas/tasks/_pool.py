@@ -0,0 +1,177 @@
+"""
+Bounded pools of external (e.g., Java) processes, shared by the threads of
+a worker process.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+
+from ..core import _config
+
+log = logging.getLogger(__name__)
+
+
+def kill(process):
+    "Kill a subprocess.Popen if it is still running, and reap it"
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+
+
+@contextmanager
+def kill_on_error(process):
+    """
+    Context manager that kills process (a subprocess.Popen) if an exception
+    occurs while talking to it: we no longer know where we are in its
+    output. The pool restarts it when it is next checked out.
+    """
+    try:
+        yield
+    except:
+        kill(process)
+        raise
+
+
+class ProcessPool(object):
+    """
+    Bounded pool of processes.
+
+    Processes are started on demand, up to size, or in advance by warm_up.
+    Callers that find all processes busy are served in first-come,
+    first-served order. A process that has died is restarted when it is
+    checked out.
+
+    Subclasses should implement _start_process, which returns a new process
+    object, and _is_alive and _restart, which take a process object.
+    """
+
+    name = "External"   # for log messages
+
+    # Configuration (see xtas.core.configure) of the pool returned by get,
+    # with keys 'processes' and 'memory', and the defaults for those.
+    config_key = None
+    defaults = {'processes': 1, 'memory': None}
+
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """
+        Get the pool of this class, constructing it on first use as
+        cls(processes, memory) from the configuration under config_key.
+        """
+        with ProcessPool._instance_lock:
+            if cls.__dict__.get('_instance') is None:
+                config = dict(cls.defaults)
+                config.update(_config.get(cls.config_key) or {})
+                cls._instance = cls(config['processes'], config['memory'])
+            return cls._instance
+
+    def __init__(self, size=1):
+        self.size = size
+        self._idle = []
+        self._started = 0
+        self._waiting = deque()
+        self._cond = threading.Condition()
+
+    def _start_process(self):
+        raise NotImplementedError()
+
+    def _is_alive(self, process):
+        raise NotImplementedError()
+
+    def _restart(self, process):
+        raise NotImplementedError()
+
+    def _start_counted(self):
+        "Start a process that has already been counted in _started"
+        try:
+            return self._start_process()
+        except:
+            self._uncount()
+            raise
+
+    def _uncount(self):
+        "Make room for a new process after one could not be (re)started"
+        with self._cond:
+            self._started -= 1
+            self._cond.notify_all()
+
+    def checkout(self):
+        "Get a process from the pool, waiting for one if necessary"
+        ticket = object()
+        with self._cond:
+            self._waiting.append(ticket)
+            while not (self._waiting[0] is ticket
+                       and (self._idle or self._started < self.size)):
+                self._cond.wait()
+            self._waiting.popleft()
+            if self._idle:
+                process = self._idle.pop()
+            else:
+                process = None
+                self._started += 1
+            self._cond.notify_all()
+
+        if process is None:
+            process = self._start_counted()
+        elif not self._is_alive(process):
+            log.warn("%s process died, respawning", self.name)
+            try:
+                self._restart(process)
+            except:
+                self._uncount()
+                raise
+        return process
+
+    def checkin(self, process):
+        "Return a process obtained from checkout to the pool"
+        with self._cond:
+            self._idle.append(process)
+            self._cond.notify_all()
+
+    def load(self):
+        "Number of processes checked out plus the number of callers waiting"
+        with self._cond:
+            return self._started - len(self._idle) + len(self._waiting)
+
+    @contextmanager
+    def process(self):
+        "Context manager that checks out a process and checks it back in"
+        process = self.checkout()
+        try:
+            yield process
+        finally:
+            self.checkin(process)
+
+    def warm_up(self, n=None, wait=False):
+        """
+        Start processes that have not been started yet, in background
+        threads. Callers of checkout wait for them to come up, rather than
+        starting processes themselves.
+
+        @param n: start at most this many processes (default: all)
+        @param wait: if True, return only when the processes are up
+        """
+        with self._cond:
+            left = self.size - self._started
+            n = left if n is None else min(n, left)
+            self._started += n
+        threads = [threading.Thread(target=self._warm_up_one)
+                   for _ in range(n)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        if wait:
+            for t in threads:
+                t.join()
+
+    def _warm_up_one(self):
+        try:
+            process = self._start_counted()
+        except Exception:
+            log.exception("Could not start %s process", self.name)
+        else:
+            self.checkin(process)
@@ -14,6 +14,10 @@ on the interactive_mode branch of vanatteveldt/semafor.
 
 git clone -b interactive_mode https://github.com/vanatteveldt/semafor
 
+Each worker process keeps a pool of Semafor processes, sized by the
+SEMAFOR configuration (see xtas.core.configure). These are started on the
+first request or, if configured, when the worker process starts.
+
 See: https://github.com/sammthomson/semafor
 (and: http://nlp.stanford.edu/software/corenlp.shtml
 """
@@ -22,21 +26,25 @@ from __future__ import absolute_import
 
 import datetime
 import json
+from multiprocessing.pool import ThreadPool
 import os
-import threading
+import re
 import subprocess
 import tempfile
 
+from ._pool import ProcessPool, kill_on_error
+
 
 class Semafor(object):
-    def __init__(self):
+    def __init__(self, memory="4g"):
+        self.memory = memory
         self.start_semafor()
 
     def start_semafor(self):
         semafor_home = os.environ["SEMAFOR_HOME"]
         model_dir = os.environ.get("MALT_MODEL_DIR", semafor_home)
         cp = os.path.join(semafor_home, "target", "Semafor-3.0-alpha-04.jar")
-        cmd = ["java","-Xms4g","-Xmx4g","-cp",cp,
+        cmd = ["java", "-Xms" + self.memory, "-Xmx" + self.memory, "-cp", cp,
                "edu.cmu.cs.lti.ark.fn.SemaforInteractive",
                "model-dir:{model_dir}".format(**locals())]
         self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
@@ -53,41 +61,102 @@ class Semafor(object):
             yield line
 
     def call_semafor(self, conll_str):
-        self.process.stdin.write(conll_str.strip())
-        self.process.stdin.write("\n\n")
-        self.process.stdin.flush()
-        lines = list(self.wait_for_prompt())
-        assert len(lines) == 1
+        with kill_on_error(self.process):
+            self.process.stdin.write(conll_str.strip())
+            self.process.stdin.write("\n\n")
+            self.process.stdin.flush()
+            lines = list(self.wait_for_prompt())
+            assert len(lines) == 1
         return json.loads(lines[0])
 
 
-_SINGLETON_LOCK = threading.Lock()
+class SemaforPool(ProcessPool):
+    """
+    Pool of Semafor processes, sized by the SEMAFOR config.
+    See ProcessPool.
+    """
+
+    name = "Semafor"
+
+    config_key = 'SEMAFOR'
+    defaults = {'processes': 1, 'memory': "4g"}
+
+    def __init__(self, size=1, memory="4g"):
+        super(SemaforPool, self).__init__(size)
+        self.memory = memory
+
+    def _start_process(self):
+        return Semafor(self.memory)
+
+    def _is_alive(self, process):
+        return process.process.poll() is None
+
+    def _restart(self, process):
+        process.start_semafor()
+
+
 def call_semafor(conll_str):
     """
-    Call semafor on the given conll_str using a thread-safe singleton instance
+    Call semafor on the given conll_str using a process from the pool
+    """
+    with SemaforPool.get().process() as semafor:
+        return semafor.call_semafor(conll_str)
+
+
+def call_semafor_many(conll_strs):
+    """
+    Call semafor on each of the given conll strings, concurrently if the
+    pool has multiple processes. Returns a list of results.
     """
-    with _SINGLETON_LOCK:
-        if not hasattr(Semafor, '_singleton'):
-            Semafor._singleton = Semafor()
-        return Semafor._singleton.call_semafor(conll_str)
+    n = min(SemaforPool.get().size, len(conll_strs))
+    if n <= 1:
+        return [call_semafor(conll) for conll in conll_strs]
+    threads = ThreadPool(n)
+    try:
+        return threads.map(call_semafor, conll_strs)
+    finally:
+        threads.close()
 
 
 def to_conll(tree):
     """
     Convert a parse tree from Penn (?) to conll
     """
+    return to_conll_many([tree])[0]
+
+
+def to_conll_many(trees):
+    """
+    Convert a list of parse trees from Penn (?) to conll
+
+    All trees are converted by a single call to the conll class (i.e.,
+    a single JVM), so callers should pass all trees of a document (or of a
+    batch of documents) at once. Returns a list with the conll string for
+    each tree.
+    """
+    if not trees:
+        return []
     classpath = os.path.join(os.environ["CORENLP_HOME"], "*")
     javaclass = "edu.stanford.nlp.trees.EnglishGrammaticalStructure"
     # create stub xml file and call the conll class
-    xml = ("<root><document><sentences><sentence>{tree}"
-           "</sentence></sentences></document></root>"
+    sentences = "".join("<sentence>{tree}</sentence>".format(tree=tree)
+                        for tree in trees)
+    xml = ("<root><document><sentences>{sentences}"
+           "</sentences></document></root>"
            .format(**locals()))
     with tempfile.NamedTemporaryFile() as f:
         f.write(xml)
         f.flush()
         cmd = ('java -cp "{classpath}" {javaclass} -conllx -treeFile {f.name}'
                .format(**locals()))
-        return subprocess.check_output(cmd, shell=True)
+        out = subprocess.check_output(cmd, shell=True)
+
+    # the conll for each tree is followed by a blank line
+    conll = [block for block in re.split(r"\n\s*\n", out) if block.strip()]
+    if len(conll) != len(trees):
+        raise Exception("Expected conll for {} trees, got {}"
+                        .format(len(trees), len(conll)))
+    return [block + "\n" for block in conll]
 
 
 def add_frames(saf_article):
@@ -100,14 +169,14 @@ def add_frames(saf_article):
                   "started": datetime.datetime.now().isoformat()}
     saf_article['header']['processed'].append(provenance)
 
-    for t in saf_article['trees']:
+    trees = saf_article['trees']
+    conlls = to_conll_many([t['tree'] for t in trees])
+    sents = call_semafor_many(conlls)
+    for t, sent in zip(trees, sents):
         sid = int(t['sentence'])
-        tree = t['tree']
-        conll = to_conll(tree)
         tokens = sorted((w for w in saf_article['tokens']
                          if w['sentence'] == sid),
                         key=lambda token: int(token['offset']))
-        sent = call_semafor(conll)
         if "error" in sent:
             err = {"module": module, "sentence": sid}
             err.update(sent)
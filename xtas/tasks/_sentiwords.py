@@ -1,18 +1,42 @@
-#from celery.signals import worker_process_init
+"""
+SentiWords lexicon and longest-match tagger.
 
+The lexicon is compiled, on first use, to a token-level trie stored as
+arrays in the xtas data directory: the sorted words in the lexicon
+(fixed-width byte strings), the edges of the trie as sorted integer keys
+(parent node * number of words + word index) with the child node of each,
+and for each node the polarity of the n-gram that ends there (NaN if none)
+and whether it has children. These are memory-mapped, so worker processes
+share a single read-only copy through the page cache.
+"""
+
+import errno
+from itertools import chain, count, izip
+import os
 import os.path
+import shutil
+import tempfile
+
+import numpy as np
 
-_TABLE = {}
-_MAX_LEN = 0
+from .._downloader import _make_data_home
 
 _SENTI_PATH = os.path.join(os.path.dirname(__file__), "sentiwords.txt")
 
+# Change when the compiled format changes.
+_FORMAT_VERSION = 2
 
-#@worker_process_init.connect
-def load():
-    max_len = 0           # max n-gram length
-    sentiment = {}
-    with open(_SENTI_PATH) as f:
+_WORDS = None
+_EDGES = None
+_CHILDREN = None
+_PRIORS = None
+_EXTENDS = None
+
+
+def read_lexicon(path=_SENTI_PATH):
+    """Generate (n-gram, prior polarity) pairs from the SentiWords file,
+    skipping n-grams with zero polarity."""
+    with open(path) as f:
         for ln in f:
             if ln.startswith('#'):
                 continue
@@ -22,33 +46,155 @@ def load():
             if prior == 0:
                 continue
 
-            max_len = max(max_len, w.count(' '))
-            sentiment[w] = prior
+            yield w, prior
+
+
+def compile_lexicon(path, directory):
+    """Compile the SentiWords file at path to words.npy, edges.npy,
+    children.npy, priors.npy and extends.npy in directory."""
+    ngrams = [(w.split(' '), prior) for w, prior in read_lexicon(path)]
+    words = sorted({w for ngram, _ in ngrams for w in ngram})
+    index = {w: i for i, w in enumerate(words)}
+
+    # Nodes are numbered in order of creation; the root is node 0.
+    trie = {}       # (parent node, word index) : child node
+    priors = [np.nan]
+    for ngram, prior in ngrams:
+        node = 0
+        for w in ngram:
+            edge = (node, index[w])
+            if edge not in trie:
+                trie[edge] = len(priors)
+                priors.append(np.nan)
+            node = trie[edge]
+        priors[node] = prior
+
+    edges = sorted(trie)
+    extends = np.zeros(len(priors), dtype=bool)
+    extends[[parent for parent, _ in edges]] = True
+
+    def save(name, array):
+        np.save(os.path.join(directory, name + ".npy"), array)
+
+    save("words", np.array(words))
+    save("edges", np.array([parent * len(words) + w for parent, w in edges],
+                           dtype=np.int64))
+    save("children", np.array([trie[e] for e in edges], dtype=np.intp))
+    save("priors", np.array(priors, dtype=np.float64))
+    save("extends", extends)
+
 
-    global _TABLE
-    global _MAX_LEN
-    _TABLE = sentiment
-    _MAX_LEN = max_len
+def _compiled_path(path=_SENTI_PATH):
+    """Directory for the compiled lexicon; it depends on the size and
+    modification time of the source, so edits cause recompilation."""
+    st = os.stat(path)
+    name = "v%d-%d-%d" % (_FORMAT_VERSION, st.st_size, st.st_mtime)
+    return os.path.join(_make_data_home('sentiwords'), name)
 
 
-load()
+def load():
+    """Memory-map the compiled lexicon, compiling it first if necessary."""
+    global _WORDS, _EDGES, _CHILDREN, _PRIORS, _EXTENDS
+
+    directory = _compiled_path()
+    if not os.path.exists(directory):
+        # Compile to a temporary directory, then move it into place, so
+        # that concurrent workers never see a partial lexicon.
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(directory))
+        try:
+            os.chmod(tmp, 0o755)
+            compile_lexicon(_SENTI_PATH, tmp)
+            os.rename(tmp, directory)
+        except OSError as e:
+            # Another process got there first.
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def load_array(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode='r')
+
+    _WORDS = load_array("words")
+    _EDGES = load_array("edges")
+    _CHILDREN = load_array("children")
+    _PRIORS = load_array("priors")
+    _EXTENDS = load_array("extends")
+
+
+def _word_indices(words):
+    "Array of the indices of words in _WORDS, -1 if absent"
+    # Text repeats words a lot, so encode and search each distinct word once.
+    unique = list(set(words))
+    position = dict(izip(unique, count()))
+    keys = np.array([w.encode('utf-8') if isinstance(w, unicode) else w
+                     for w in unique])
+    i = np.minimum(_WORDS.searchsorted(keys), len(_WORDS) - 1)
+    # Comparing at the width of keys, keys longer than any word (which
+    # searchsorted truncates) are not found.
+    indices = np.where(_WORDS[i] == keys, i, -1)
+    return indices[[position[w] for w in words]]
+
+
+def _children(nodes, words):
+    """Array of the children of nodes along the edges for word indices
+    words, -1 where there is no such edge"""
+    keys = nodes * len(_WORDS) + words
+    i = np.minimum(_EDGES.searchsorted(keys), len(_EDGES) - 1)
+    return np.where((words >= 0) & (_EDGES[i] == keys), _CHILDREN[i], -1)
 
 
 def tag(words):
-    def try_position(k):
-        for j in xrange(_MAX_LEN, 0, -1):
-            ngram = ' '.join(words[i:i+j])
-            try:
-                return j, ngram, _TABLE[ngram]
-            except KeyError:
-                pass
+    """Left-to-right, longest-match tagging of words.
 
+    Returns an iterator over (n-gram, polarity) pairs, where n-gram is a
+    string, covering all words; words not in a SentiWords n-gram get
+    polarity zero.
+    """
+    if _WORDS is None:
+        load()
+    if not words:
+        return iter([])
+
+    # Find the longest n-gram starting at each word by walking down the
+    # trie from all words at once, one level per iteration, as long as the
+    # nodes reached have children. ends[i] is the end of the longest n-gram
+    # starting at i (0 if none), priors[i] its polarity.
+    n = len(words)
+    indices = _word_indices(words)
+    ends = np.zeros(n, dtype=np.intp)
+    priors = np.zeros(n)
+    starts = np.arange(n)
+    nodes = np.zeros(n, dtype=np.int64)
+    depth = 1
+    while len(starts):
+        nodes = _children(nodes, indices[starts + depth - 1])
+        found = nodes >= 0
+        starts, nodes = starts[found], nodes[found]
+        polarity = _PRIORS[nodes]
+        ngram = ~np.isnan(polarity)
+        ends[starts[ngram]] = starts[ngram] + depth
+        priors[starts[ngram]] = polarity[ngram]
+        # Go on from nodes with children, if there are words left.
+        more = _EXTENDS[nodes] & (starts + depth < n)
+        starts, nodes = starts[more], nodes[more]
+        depth += 1
+
+    # Left to right, only multi-word n-grams skip words; between those,
+    # each word is tagged on its own.
+    multi = np.flatnonzero(ends > np.arange(1, n + 1)).tolist()
+    priors = priors.astype(object)
+    priors[ends == 0] = 0   # an int, as for words tagged one by one
+    priors = priors.tolist()
+    ends = ends.tolist()
+    segments = []
     i = 0
-    while i < len(words):
-        try:
-            skip, ngram, polarity = try_position(i)
-            yield ngram, polarity
-            i += skip
-        except TypeError:
-            yield words[i], 0
-            i += 1
+    for j in multi:
+        if j < i:
+            continue    # part of the previous n-gram
+        segments.append(izip(words[i:j], priors[i:j]))
+        segments.append([(' '.join(words[j:ends[j]]), priors[j])])
+        i = ends[j]
+    segments.append(izip(words[i:], priors[i:]))
+    return chain.from_iterable(segments)
@@ -1,3 +1,10 @@
+"""
+Stanford NER, run as a pool of server processes (see NERServer.java).
+
+The server processes are started on first use or, if configured by
+STANFORD_NER (see xtas.core.configure), when a worker process starts.
+"""
+
 from __future__ import absolute_import, print_function
 from itertools import groupby
 import logging
@@ -6,6 +13,7 @@ import os
 import os.path
 from subprocess import Popen, PIPE
 from tempfile import NamedTemporaryFile
+import threading
 from zipfile import ZipFile
 
 from six.moves.urllib.request import urlretrieve
@@ -13,6 +21,7 @@ from six.moves.urllib.request import urlretrieve
 import nltk
 
 from .._downloader import _make_data_home, _progress
+from ._pool import ProcessPool, kill_on_error
 
 
 logger = logging.getLogger(__name__)
@@ -37,20 +46,91 @@ def download():
     return ner_dir
 
 
-# Download and start server at import, not call time. Import is done lazily.
-ner_dir = download()
-jar = os.path.join(ner_dir, 'stanford-ner.jar')
-model = os.path.join(ner_dir,
-                     'classifiers/english.all.3class.distsim.crf.ser.gz')
-classpath = '%s:%s' % (jar, os.path.dirname(__file__))
-server = Popen(['java', '-mx1000m', '-cp', classpath, 'NERServer', model],
-               stdin=PIPE, stdout=PIPE)
-
-
-def tag(doc, format):
-    if format not in ["tokens", "names"]:
-        raise ValueError("unknown format %r" % format)
-
+class NERServer(object):
+    """
+    A Stanford NER server process (see NERServer.java).
+
+    The server reads one line of text at a time and writes the tagged tokens
+    on a single line, so each request is framed by a newline.
+    """
+
+    def __init__(self, memory="1000m"):
+        self.memory = memory
+        self.start_server()
+
+    def start_server(self):
+        ner_dir = download()
+        jar = os.path.join(ner_dir, 'stanford-ner.jar')
+        model = os.path.join(
+            ner_dir, 'classifiers/english.all.3class.distsim.crf.ser.gz')
+        classpath = '%s:%s' % (jar, os.path.dirname(__file__))
+        self.process = Popen(['java', '-mx' + self.memory, '-cp', classpath,
+                              'NERServer', model],
+                             stdin=PIPE, stdout=PIPE)
+
+    def tag_lines(self, lines):
+        """
+        Tag lines of text (byte strings without newlines) and return the
+        output line for each.
+
+        All lines are written, by a separate thread, before the output is
+        read, so the server need not wait for us between lines.
+        """
+        with kill_on_error(self.process):
+            # The writer is given this process's stdin, so that it cannot
+            # write to a new process if this one is killed and respawned.
+            stdin = self.process.stdin
+            if len(lines) == 1:
+                _write(stdin, lines)
+            else:
+                writer = threading.Thread(target=_write, args=(stdin, lines))
+                writer.daemon = True
+                writer.start()
+            output = []
+            for _ in lines:
+                line = self.process.stdout.readline()
+                if not line:
+                    raise Exception("Stanford NER server died")
+                output.append(line)
+            return output
+
+
+def _write(stdin, lines):
+    try:
+        for line in lines:
+            stdin.write(line + '\n')
+        stdin.flush()
+    except IOError:
+        # Server died; tag_lines finds out when reading.
+        logger.exception("Could not write to Stanford NER server")
+
+
+class NERPool(ProcessPool):
+    """
+    Pool of Stanford NER servers, sized by the STANFORD_NER config.
+    See ProcessPool.
+    """
+
+    name = "Stanford NER"
+
+    config_key = 'STANFORD_NER'
+    defaults = {'processes': 1, 'memory': "1000m"}
+
+    def __init__(self, size=1, memory="1000m"):
+        super(NERPool, self).__init__(size)
+        self.memory = memory
+
+    def _start_process(self):
+        return NERServer(self.memory)
+
+    def _is_alive(self, process):
+        return process.process.poll() is None
+
+    def _restart(self, process):
+        process.start_server()
+
+
+def _to_line(doc):
     # If the doc contains unicode characters, a UnicodeEncodeError was thrown
     # in s.sendall(text). E.g. presumably the euro-sign:
     # UnicodeEncodeError: 'ascii' codec can't encode character u'\u20ac' in
@@ -60,14 +140,13 @@ def tag(doc, format):
     # results in the above error. Encoding each list item first fixes the
     # problem.
 
+    # Tokens are joined by spaces, so the line contains no newlines.
     toks = nltk.word_tokenize(doc)
-    text = ' '.join(t.encode('utf-8') for t in toks)
+    return ' '.join(t.encode('utf-8') for t in toks)
 
-    server.stdin.write(text)
-    server.stdin.write('\n')
 
-    tagged = [token.rsplit('/', 1)
-              for token in server.stdout.readline().split()]
+def _from_line(line, format):
+    tagged = [token.rsplit('/', 1) for token in line.split()]
 
     if format == "tokens":
         return tagged
@@ -75,3 +154,22 @@ def tag(doc, format):
         return [(' '.join(token for token, _ in tokens), cls)
                 for cls, tokens in groupby(tagged, operator.itemgetter(1))
                 if cls != 'O']
+
+
+def tag(doc, format):
+    return tag_many([doc], format)[0]
+
+
+def tag_many(docs, format):
+    """
+    Tag multiple documents, pipelining them through one server process.
+    Returns a list with the result for each document.
+    """
+    if format not in ["tokens", "names"]:
+        raise ValueError("unknown format %r" % format)
+    lines = [_to_line(doc) for doc in docs]
+    if not lines:
+        return []
+    with NERPool.get().process() as server:
+        output = server.tag_lines(lines)
+    return [_from_line(line, format) for line in output]
@@ -0,0 +1,114 @@
+"""
+Loading of heavy resources when a worker process starts.
+
+Models, lexicons and external processes are otherwise loaded by the first
+task that needs them, which may then take minutes and hit time limits.
+The resources listed in the WARMUP configuration (see xtas.core.configure)
+are loaded on worker_process_init instead. Celery only hands tasks to a
+worker process after that, but it also kills processes that do not come up
+in time, so the timeout is raised to WARMUP['timeout'].
+
+Each worker process has its own pools of external processes (CoreNLP,
+Semafor, Stanford NER), so only one process per pool is started here; with
+N worker processes, starting the full pools would take N times the
+configured number of JVMs. Further processes are started on demand.
+"""
+
+from __future__ import absolute_import
+
+import logging
+from timeit import default_timer as timer
+
+from celery.signals import worker_init, worker_process_init
+
+from ..core import _config
+
+logger = logging.getLogger(__name__)
+
+
+def _nltk():
+    from .._utils import nltk_resource
+    nltk_resource('lemmatizer')
+    nltk_resource('pos_tagger')
+
+
+def _sentiwords():
+    from ._sentiwords import load
+    load()
+
+
+def _polarity():
+    from ._polarity import get_model
+    get_model()
+
+
+def _corenlp():
+    # One pool per annotator set: those of the corenlp and corenlp_lemmatize
+    # tasks.
+    from ._corenlp import CoreNLPPool, LEMMATIZE_ANNOTATORS
+    for annotators in (None, LEMMATIZE_ANNOTATORS):
+        CoreNLPPool.get(annotators).warm_up(1, wait=True)
+
+
+def _semafor():
+    from ._semafor import SemaforPool
+    SemaforPool.get().warm_up(1, wait=True)
+
+
+def _stanford_ner():
+    from ._stanford_ner import NERPool
+    NERPool.get().warm_up(1, wait=True)
+
+
+# Name : function that loads the resource.
+RESOURCES = {
+    'nltk': _nltk,
+    'sentiwords': _sentiwords,
+    'polarity': _polarity,
+    'corenlp': _corenlp,
+    'semafor': _semafor,
+    'stanford_ner': _stanford_ner,
+}
+
+
+def warm_up(resources):
+    """Load the named resources, in order.
+
+    Failures are logged, not raised, so that a worker process comes up even
+    if a resource is unavailable. Returns a dict with the time in seconds
+    that loading each resource took.
+    """
+    timings = {}
+    start = timer()
+    for name in resources:
+        t = timer()
+        try:
+            RESOURCES[name]()
+        except Exception:
+            logger.exception("Warm-up of %r failed", name)
+        else:
+            timings[name] = timer() - t
+            logger.info("Warm-up of %r took %.2f s", name, timings[name])
+    logger.info("Warm-up took %.2f s", timer() - start)
+    return timings
+
+
+@worker_init.connect
+def _raise_startup_timeout(**kwargs):
+    """Give worker processes time to warm up before Celery considers them
+    dead (only applies to the prefork pool of Celery >= 3.1)."""
+    config = _config.get('WARMUP') or {}
+    if config.get('resources'):
+        try:
+            from celery.concurrency import asynpool
+        except ImportError:
+            return
+        asynpool.PROC_ALIVE_TIMEOUT = max(asynpool.PROC_ALIVE_TIMEOUT,
+                                          config.get('timeout', 600))
+
+
+@worker_process_init.connect
+def _warm_up(**kwargs):
+    config = _config.get('WARMUP') or {}
+    if config.get('resources'):
+        warm_up(config['resources'])
@@ -0,0 +1,239 @@
+"""Content-addressed caching of results on plain-text input.
+
+Results are keyed by the SHA-1 hash of the input text plus a stage key that
+identifies the task(s) and arguments that produced them. Caching is
+configured with ``RESULT_CACHE`` (see ``xtas.core.configure``) and is off by
+default.
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import hashlib
+import inspect
+import json
+import os
+import os.path
+import sqlite3
+import threading
+import time
+
+from ..core import app
+from .._downloader import _make_data_home
+from .._utils import per_process
+
+
+class LRUCache(object):
+    """Thread-safe, in-process least recently used cache.
+
+    Values are stored as given; ResultCache stores them as JSON strings.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value    # move to the end
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+class SQLiteStore(object):
+    """Key-value store in an SQLite database file.
+
+    The file can be shared by all worker processes on a machine. Each thread
+    in each process gets its own connection.
+
+    Entries older than ttl seconds (if not None) are not returned. Every
+    prune_every writes, expired entries are deleted, as are the oldest
+    entries beyond max_size (if not None), so the file stops growing.
+    """
+
+    def __init__(self, path, max_size=1000000, ttl=None, prune_every=1000):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._local = threading.local()
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entries"
+                         " (key TEXT PRIMARY KEY, value TEXT,"
+                         " stored REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_stored"
+                         " ON entries (stored)")
+            conn.commit()
+            local.conn, local.pid, local.writes = conn, os.getpid(), 0
+        return local.conn
+
+    def get(self, key, default=None):
+        oldest = 0 if self.ttl is None else time.time() - self.ttl
+        row = self._connection().execute(
+            "SELECT value FROM entries WHERE key = ? AND stored >= ?",
+            (key, oldest)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value):
+        conn = self._connection()
+        conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                     (key, value, time.time()))
+        conn.commit()
+        self._local.writes += 1
+        if self._local.writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """Delete expired entries and the oldest entries beyond max_size."""
+        conn = self._connection()
+        if self.ttl is not None:
+            conn.execute("DELETE FROM entries WHERE stored < ?",
+                         (time.time() - self.ttl,))
+        if self.max_size is not None:
+            conn.execute("DELETE FROM entries WHERE key IN"
+                         " (SELECT key FROM entries ORDER BY stored DESC"
+                         " LIMIT -1 OFFSET ?)", (self.max_size,))
+        conn.commit()
+
+
+class ResultCache(object):
+    """Two-tier result cache.
+
+    Looks in an in-process LRU cache first, then in an optional shared
+    backend: any object with get(key, default) and set(key, value) methods
+    for string keys and values. Values are stored as JSON, so results come
+    back as they would through the Celery JSON serializer.
+    """
+
+    def __init__(self, lru_size=1000, backend=None):
+        self.lru = LRUCache(lru_size)
+        self.backend = backend
+
+    def get(self, key, default=None):
+        value = self.lru.get(key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.lru.set(key, value)
+        return default if value is None else json.loads(value)
+
+    def get_many(self, keys):
+        """Return a dict with the cached values for keys, omitting misses."""
+        missing = object()
+        values = ((key, self.get(key, missing)) for key in keys)
+        return {key: value for key, value in values if value is not missing}
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        self.lru.set(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+
+@per_process('RESULT_CACHE')
+def get_cache(config):
+    """Return the ResultCache for the current process, or None if caching is
+    not configured."""
+    if not config:
+        return None
+    backend = config.get('backend', 'sqlite')
+    if backend == 'sqlite':
+        path = config.get('path') or os.path.join(_make_data_home(),
+                                                  'result_cache.sqlite')
+        backend = SQLiteStore(path, config.get('max_size', 1000000),
+                              config.get('ttl'))
+    return ResultCache(config.get('lru_size', 1000), backend)
+
+
+def content_key(text, stage_key):
+    """Cache key for the result of a stage on the given text."""
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return "%s:%s" % (hashlib.sha1(text).hexdigest(), stage_key)
+
+
+def stage_keys(tasks, versions=None):
+    """Derive cache keys for all prefixes of a chain of task signatures.
+
+    The key of a prefix is the short name of its last task, followed by a
+    hash over the names, arguments and versions of all tasks in the prefix.
+    Arguments are canonicalized by binding them to the task's parameters,
+    so that e.g. pos_tag(), pos_tag("nltk") and pos_tag(model="nltk") get
+    the same key, while pos_tag(model="other") does not.
+
+    Parameters
+    ----------
+    tasks : list of Celery signatures
+        The document argument should not be part of the signatures.
+    versions : list, optional
+        Version (any JSON-serializable value) of each task, or None.
+    """
+    if versions is None:
+        versions = [None] * len(tasks)
+    keys = []
+    h = hashlib.sha1()
+    for task, version in zip(tasks, versions):
+        try:
+            run = app.tasks[task.task].run
+            args = inspect.getcallargs(run, None, *task.args, **task.kwargs)
+            del args[inspect.getargspec(run).args[0]]   # the document
+        except (IndexError, TypeError):
+            # Can't bind (e.g. *args or a mismatch that the task will report
+            # when it's called); use the arguments as given.
+            args = [task.args, task.kwargs]
+        desc = [task.task, args, version]
+        h.update(json.dumps(desc, sort_keys=True, separators=(',', ':')))
+        keys.append("%s__%s" % (task.task.rsplit('.', 1)[-1],
+                                h.hexdigest()[:16]))
+    return keys
+
+
+class CachedTask(app.Task):
+    """Base class for tasks that cache their results on plain-text input.
+
+    Input other than a string (e.g. an ES document handle or a token list)
+    is passed through to the task without caching.
+    """
+    abstract = True
+
+    def __call__(self, doc, *args, **kwargs):
+        call = super(CachedTask, self).__call__
+        cache = get_cache()
+        if cache is None or not isinstance(doc, basestring):
+            return call(doc, *args, **kwargs)
+
+        key = content_key(doc, stage_keys([self.s(*args, **kwargs)])[0])
+        missing = object()
+        result = cache.get(key, missing)
+        if result is missing:
+            result = call(doc, *args, **kwargs)
+            cache.set(key, result)
+        return result
+
+
+@app.task
+def cache_result(data, key):
+    """Store data in the result cache under key (from content_key).
+
+    Returns data, so this can be used as a link in a chain.
+    """
+    cache = get_cache()
+    if cache is not None:
+        cache.set(key, data)
+    return data
@@ -1,19 +1,22 @@
-"""Clustering and topic modelling tasks.
+"""Clustering, topic modelling and other batch tasks.
 
 These tasks process batches of documents, denoted as lists of strings.
 """
 
 from __future__ import absolute_import
 
+import logging
 import operator
 
 from six import itervalues
 import toolz
 
-from .es import fetch
+from .es import fetch_many
 from ..core import app
 from .._utils import tosequence
 
+logger = logging.getLogger(__name__)
+
 
 def _vectorizer(**kwargs):
     """Construct a TfidfVectorizer with sane settings."""
@@ -75,23 +78,29 @@ def kmeans(docs, k, lsa=None):
         kmeans = Pipeline([('tfidf', _vectorizer()),
                            ('kmeans', MiniBatchKMeans(n_clusters=k))])
 
-    labels = kmeans.fit(fetch(d) for d in docs).steps[-1][1].labels_
+    labels = kmeans.fit(fetch_many(docs)).steps[-1][1].labels_
     return group_clusters(docs, labels)
 
 
-@app.task
-def big_kmeans(docs, k, batch_size=1000, n_features=(2 ** 20),
+@app.task(bind=True)
+def big_kmeans(self, docs, k, batch_size=1000, n_features=(2 ** 20),
                single_pass=True):
     """k-means for very large sets of documents.
 
     See kmeans for documentation. Differs from that function in that it does
-    not computer tf-idf or LSA, and fetches the documents in a streaming
+    not compute tf-idf or LSA, and fetches the documents in a streaming
     fashion, so they don't need to be held in memory. It does not do random
     restarts.
 
-    If the option single_pass is set to False, the documents are visited
-    twice: once to fit a k-means model, once to determine their label in
-    this model.
+    The model is updated with each batch of batch_size documents in turn,
+    and the documents in a batch are labeled by the model as it stands after
+    that update. If the option single_pass is set to False, the documents
+    are visited twice: once to fit a k-means model, once to determine their
+    label in the final model.
+
+    Progress is logged and, when run as a Celery task, reported as the task
+    state PROGRESS with metadata {'pass': 1 or 2, 'done': number of
+    documents processed in this pass, 'total': number of documents}.
     """
     from sklearn.cluster import MiniBatchKMeans
     from sklearn.feature_extraction.text import HashingVectorizer
@@ -99,25 +108,38 @@ def big_kmeans(docs, k, batch_size=1000, n_features=(2 ** 20),
     docs = tosequence(docs)
 
     v = HashingVectorizer(input="content", n_features=n_features, norm="l2")
-    km = MiniBatchKMeans(n_clusters=k)
+    km = MiniBatchKMeans(n_clusters=k, compute_labels=single_pass)
+
+    def batches(n_pass):
+        done = 0
+        for batch in toolz.partition_all(batch_size,
+                                         fetch_many(docs, batch_size)):
+            yield v.transform(batch)
+            done += len(batch)
+            _report_progress(self, n_pass, done, len(docs))
 
     labels = []
-    for batch in toolz.partition_all(batch_size, docs):
-        batch = map(fetch, docs)
-        batch = v.transform(batch)
-        y = km.fit_predict(batch)
+    for X in batches(1):
+        km.partial_fit(X)
         if single_pass:
-            labels.extend(y.tolist())
+            labels.extend(km.labels_.tolist())
 
     if not single_pass:
-        for batch in toolz.partition_all(batch_size, docs):
-            batch = map(fetch, docs)
-            batch = v.transform(batch)
-            labels.extend(km.predict(batch).tolist())
+        for X in batches(2):
+            labels.extend(km.predict(X).tolist())
 
     return group_clusters(docs, labels)
 
 
+def _report_progress(task, n_pass, done, total):
+    logger.info("%s: pass %d, %d/%d documents", task.name, n_pass, done,
+                total)
+    if task.request.id is not None:
+        task.update_state(state='PROGRESS',
+                          meta={'pass': n_pass, 'done': done,
+                                'total': total})
+
+
 @app.task
 def lsa(docs, k, random_state=None):
     """Latent semantic analysis.
@@ -143,7 +165,7 @@ def lsa(docs, k, random_state=None):
     vect = _vectorizer()
     svd = TruncatedSVD(n_components=k)
     pipe = Pipeline([('tfidf', vect), ('svd', svd)])
-    pipe.fit(docs)
+    pipe.fit(fetch_many(docs))
 
     vocab = vect.vocabulary_
     return [zip(vocab, comp) for comp in svd.components_]
@@ -167,7 +189,7 @@ def lda(docs, k):
     # Use a scikit-learn vectorizer rather than Gensim's equivalent
     # for speed and consistency with LSA and k-means.
     vect = _vectorizer()
-    corpus = vect.fit_transform(fetch(d) for d in docs)
+    corpus = vect.fit_transform(fetch_many(docs))
     corpus = Sparse2Corpus(corpus)
 
     model = LdaModel(corpus=corpus, num_topics=k)
@@ -185,3 +207,111 @@ def parsimonious_wordcloud(docs, w=.5, k=10):
 
     model = ParsimoniousLM(docs, w=w)
     return [model.top(10, d) for d in docs]
+
+
+@app.task
+def movie_review_polarity_batch(docs):
+    """Movie review polarity classifier for a batch of documents.
+
+    Like ``movie_review_polarity``, but fetches the documents in bulk and
+    classifies them all in one go.
+
+    Parameters
+    ----------
+    docs : list of documents
+        Strings or handles on documents in the ES store.
+
+    Returns
+    -------
+    p : list of float
+        For each document, the probability that it is positive.
+    """
+    from ._polarity import classify_many
+    return classify_many(list(fetch_many(docs))).tolist()
+
+
+@app.task(fusable=False)
+def corenlp_batch(docs, output='raw', annotators=None):
+    """Run many (short) documents through CoreNLP in one go.
+
+    Like the corenlp task, but sends all documents to a resident CoreNLP
+    process in one interaction, which is much faster for short texts such
+    as tweets or headlines.
+
+    Parameters
+    ----------
+    docs : list of documents
+        Strings or handles on documents in the ES store.
+    output : string
+        If 'raw', returns the raw output lines from CoreNLP per document.
+        If 'saf', returns a SAF dictionary per document.
+    annotators : list of strings, optional
+        CoreNLP annotators to run; default is all.
+
+    Returns
+    -------
+    results : list
+        One result per document, in the order of docs.
+    """
+    from ._corenlp import parse_many, stanford_to_saf
+
+    try:
+        transf = {"raw": toolz.identity, "saf": stanford_to_saf}[output]
+    except KeyError:
+        raise ValueError("Unknown output format %r" % output)
+
+    return [transf(lines)
+            for lines in parse_many(fetch_many(docs), annotators)]
+
+
+@app.task
+def stanford_ner_batch(docs, output="tokens"):
+    """Named entity recognition on a batch of documents with Stanford NER.
+
+    Like ``stanford_ner_tag``, but the documents are pipelined through one
+    Stanford NER server, without waiting for the result of one document
+    before sending the next.
+
+    Parameters
+    ----------
+    docs : list of documents
+        Strings or handles on documents in the ES store.
+    output : string
+        "tokens" or "names"; see ``stanford_ner_tag``.
+
+    Returns
+    -------
+    results : list
+        One result per document, in the order of docs.
+    """
+    from ._stanford_ner import tag_many
+    return tag_many(list(fetch_many(docs)), output)
+
+
+@app.task
+def frog_batch(docs, output='raw'):
+    """Run a batch of documents through Frog.
+
+    Like ``frog``, but all documents are sent over one persistent
+    connection, without waiting for the output for one document before
+    sending the next.
+
+    Parameters
+    ----------
+    docs : list of documents
+        Strings or handles on documents in the ES store.
+    output : string
+        'raw', 'tokens', 'saf' or 'table'; see ``frog``.
+
+    Returns
+    -------
+    results : list
+        One result per document, in the order of docs.
+    """
+    from ._frog import call_frog_many, convert
+    if output not in ('raw', 'tokens', 'saf', 'table'):
+        raise ValueError("Unknown output: {output}, "
+                         "please choose either raw, tokens, saf or table"
+                         .format(**locals()))
+    return [convert(lines, output)
+            for lines in call_frog_many(fetch_many(docs))]
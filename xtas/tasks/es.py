@@ -2,17 +2,40 @@
 
 from __future__ import absolute_import
 from datetime import datetime
+import logging
+import os
+import threading
 
+from celery.signals import worker_process_shutdown
 from six import iteritems
 
 from chardet import detect as chardetect
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.helpers import bulk, scan
+from toolz import partition_all
 
-from ..core import app, _config
+from ..core import app
+from .._utils import per_process
 
 
-def _es():
-    return Elasticsearch(hosts=_config['ELASTICSEARCH'])
+logger = logging.getLogger(__name__)
+
+
+@per_process('ELASTICSEARCH')
+def _es(config):
+    """Return the Elasticsearch client for the current process.
+
+    The client, with its pool of persistent connections, is constructed on
+    first use and reused afterwards; see xtas._utils.per_process.
+    """
+    if isinstance(config, dict):
+        options = dict(config)
+        hosts = options.pop('hosts')
+    else:
+        options = {}
+        hosts = config
+    return Elasticsearch(hosts=hosts, **options)
 
 
 _ES_DOC_FIELDS = ('index', 'type', 'id', 'field')
@@ -28,6 +51,10 @@ def es_document(idx, typ, id, field):
     return {'index': idx, 'type': typ, 'id': id, 'field': field}
 
 
+def _is_es_document(doc):
+    return isinstance(doc, dict) and set(doc.keys()) == set(_ES_DOC_FIELDS)
+
+
 def fetch(doc):
     """Fetch document (if necessary).
 
@@ -45,30 +72,135 @@ def fetch(doc):
     content : string
         Document contents.
     """
-    if isinstance(doc, dict) and set(doc.keys()) == set(_ES_DOC_FIELDS):
+    if _is_es_document(doc):
         idx, typ, id, field = [doc[k] for k in _ES_DOC_FIELDS]
         return _es().get_source(index=idx, doc_type=typ, id=id)[field]
     elif isinstance(doc, unicode):
         return doc
     elif isinstance(doc, str):
-        enc = chardetect(doc)['encoding']
+        # chardet gives no encoding for, e.g., the empty string
+        enc = chardetect(doc)['encoding'] or 'ascii'
         return doc.decode(enc, errors="replace")
     else:
         raise TypeError("fetch expected es_document or string, got %s"
                         % type(doc))
 
 
+def fetch_many(docs, chunk_size=500):
+    """Fetch multiple documents (if necessary).
+
+    Like fetch, but handles on documents in the ES store are retrieved with
+    one multi-get request per chunk of documents instead of a round trip per
+    document. Only the requested field is transferred.
+
+    Parameters
+    ----------
+    docs : iterable over {dict, string}
+        Handles returned by es_document and/or plain strings, in any mix.
+    chunk_size : integer, optional
+        Maximum number of documents to request from ES in one go.
+
+    Returns
+    -------
+    contents : iterable over strings
+        Document contents, in the same order as docs.
+    """
+    for chunk in partition_all(chunk_size, docs):
+        handles = [doc for doc in chunk if _is_es_document(doc)]
+        if handles:
+            # Group by index and type, so ES can serve each group from the
+            # same shards; we restore the input order below.
+            order = sorted(range(len(handles)),
+                           key=lambda i: (handles[i]['index'],
+                                          handles[i]['type']))
+            body = {'docs': [{'_index': handles[i]['index'],
+                              '_type': handles[i]['type'],
+                              '_id': handles[i]['id'],
+                              '_source': [handles[i]['field']]}
+                             for i in order]}
+            found = [None] * len(handles)
+            for i, r in zip(order, _es().mget(body=body)['docs']):
+                found[i] = r
+            found = iter(found)
+
+        for doc in chunk:
+            if _is_es_document(doc):
+                r = next(found)
+                if not r.get('found'):
+                    raise NotFoundError(404, "document not found: %r" % doc)
+                yield r['_source'][doc['field']]
+            else:
+                yield fetch(doc)
+
+
+def fetch_query(idx, typ, query, field='body', page_size=500, scroll='5m'):
+    """Stream the contents of all documents matching query.
+
+    Walks over all matches using the ES scroll API, fetching page_size
+    documents (per shard) at a time, so the result set need not fit in
+    memory. Documents that don't have the required field are silently
+    skipped.
+
+    Parameters
+    ----------
+    idx, typ : string
+        Index and document type to search.
+    query : dict
+        Elasticsearch query.
+    field : string, optional
+        Field to return the contents of.
+    page_size : integer, optional
+        Number of hits per shard to fetch in one scroll request.
+    scroll : string, optional
+        Time to keep the scroll context alive between requests.
+
+    Returns
+    -------
+    contents : iterable over strings
+    """
+    hits = scan(_es(), query={'query': query}, scroll=scroll, index=idx,
+                doc_type=typ, size=page_size, _source=[field])
+    for hit in hits:
+        content = hit.get('_source', {}).get(field)
+        if content is not None:
+            yield content
+
+
+def fetch_query_handles(idx, typ, query, field='body', page_size=500,
+                        scroll='5m'):
+    """Stream handles on all documents matching query.
+
+    Like fetch_query, but yields es_document handles on field instead of the
+    field contents, so that the documents can be fetched lazily (e.g., by the
+    tasks that process them). No document contents are transferred, so this
+    does not check whether the field exists.
+    """
+    hits = scan(_es(), query={'query': query}, scroll=scroll, index=idx,
+                doc_type=typ, size=page_size, _source=False)
+    for hit in hits:
+        yield es_document(hit['_index'], hit['_type'], hit['_id'], field)
+
+
 @app.task
-def fetch_query_batch(idx, typ, query, field='body'):
+def fetch_query_batch(idx, typ, query, field='body', page_size=500):
     """Fetch all documents matching query and return them as a list.
 
     Returns a list of field contents, with documents that don't have the
-    required field silently filtered out.
+    required field silently filtered out. See fetch_query for a streaming
+    version.
+    """
+    return list(fetch_query(idx, typ, query, field, page_size=page_size))
+
+
+@app.task
+def fetch_query_batch_handles(idx, typ, query, field='body', page_size=500):
+    """Return handles on all documents matching query as a list.
+
+    The handles can be passed to batch tasks in place of the documents
+    themselves, which are then fetched by the task.
     """
-    r = _es().search(index=idx, doc_type=typ, body={'query': query},
-                   _source=[field])
-    r = (hit['_source'].get(field, None) for hit in r['hits']['hits'])
-    return [hit for hit in r if hit is not None]
+    return list(fetch_query_handles(idx, typ, query, field,
+                                    page_size=page_size))
 
 
 @app.task
@@ -84,6 +216,154 @@ def store_single(data, taskname, idx, typ, id, return_data=True):
     return data if return_data else None
 
 
+class BulkWriter(object):
+    """Buffers results and stores them using the ES bulk API.
+
+    Results added with add() are sent to ES in one bulk request when the
+    buffer holds max_size results, when the oldest buffered result is
+    max_delay seconds old, or when flush() is called explicitly. A
+    BulkWriter can be used as a context manager to flush when done.
+
+    Parameters
+    ----------
+    max_size : integer, optional
+        Maximum number of results to buffer.
+    max_delay : float, optional
+        Maximum number of seconds to buffer a result. If None, results are
+        only flushed when max_size is reached or by calling flush().
+    """
+
+    def __init__(self, max_size=500, max_delay=None):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, taskname, idx, typ, id, data):
+        """Buffer data for storage in xtas_results.taskname of a document.
+
+        Returns the failures from the bulk request, if this triggered one.
+        """
+        now = datetime.now().isoformat()
+        doc = {"xtas_results": {taskname: {'data': data, 'timestamp': now}}}
+        action = {'_op_type': 'update', '_index': idx, '_type': typ,
+                  '_id': id, 'doc': doc}
+        with self._lock:
+            self._buffer.append(action)
+            full = len(self._buffer) >= self.max_size
+            if (not full and self.max_delay is not None
+                    and self._timer is None):
+                self._timer = threading.Timer(self.max_delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return self.flush() if full else []
+
+    def flush(self):
+        """Send all buffered results to ES.
+
+        Returns
+        -------
+        failures : list of dict
+            For each result that could not be stored, a dict with keys
+            _index, _type, _id, status (HTTP status code) and error (message
+            string).
+        """
+        with self._lock:
+            actions, self._buffer = self._buffer, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not actions:
+            return []
+
+        _, errors = bulk(_es(), actions, chunk_size=self.max_size,
+                         raise_on_error=False, raise_on_exception=False)
+        failures = [_bulk_failure(item['update']) for item in errors]
+        for f in failures:
+            logger.warn("Failed to store result for %s/%s/%s: %s"
+                        % (f['_index'], f['_type'], f['_id'], f['error']))
+        return failures
+
+
+def _bulk_failure(item):
+    """Reduce a failed bulk item to JSON-serializable fields; when the whole
+    request failed, items also hold the exception and the data sent."""
+    error = item.get('error')
+    if isinstance(error, dict):     # ES >= 2.0: {"type": ..., "reason": ...}
+        error = "%s: %s" % (error.get('type'), error.get('reason'))
+    elif error is not None and not isinstance(error, basestring):
+        error = str(error)
+    return {'_index': item.get('_index'), '_type': item.get('_type'),
+            '_id': item.get('_id'), 'status': item.get('status'),
+            'error': error}
+
+
+@app.task
+def store_many(items, chunk_size=500):
+    """Store many results using the ES bulk API.
+
+    Parameters
+    ----------
+    items : list of tuples
+        (taskname, idx, typ, id, data) tuples. Each data is stored in the
+        xtas_results.taskname property of the given document, like
+        store_single does.
+    chunk_size : integer, optional
+        Number of results to send per bulk request.
+
+    Returns
+    -------
+    failures : list of dict
+        The results that could not be stored; see BulkWriter.flush.
+    """
+    writer = BulkWriter(max_size=chunk_size)
+    failures = []
+    for taskname, idx, typ, id, data in items:
+        failures.extend(writer.add(taskname, idx, typ, id, data))
+    failures.extend(writer.flush())
+    return failures
+
+
+_WRITER = None
+_WRITER_PID = None
+
+
+def _buffered_writer():
+    """Return the BulkWriter for the current process."""
+    global _WRITER, _WRITER_PID
+
+    if _WRITER is None or _WRITER_PID != os.getpid():
+        _WRITER = BulkWriter(max_size=500, max_delay=5.)
+        _WRITER_PID = os.getpid()
+    return _WRITER
+
+
+@worker_process_shutdown.connect
+def _flush_buffered_writer(**kwargs):
+    if _WRITER is not None and _WRITER_PID == os.getpid():
+        _WRITER.flush()
+
+
+@app.task
+def store_buffered(data, taskname, idx, typ, id, return_data=True):
+    """Buffered version of store_single.
+
+    Instead of sending an update request immediately, the result is added
+    to a per-process BulkWriter, which stores results in bulk after 500
+    results or five seconds, whichever comes first. Failures are logged,
+    since they cannot be reported back to the task that produced the result.
+    """
+    _buffered_writer().add(taskname, idx, typ, id, data)
+    return data if return_data else None
+
+
 def get_all_results(idx, typ, id):
     """
     Get all xtas results for the document
@@ -97,6 +377,32 @@ def get_all_results(idx, typ, id):
         return {}
 
 
+def get_many_results(docs, chunk_size=500):
+    """Get all xtas results for multiple documents.
+
+    Uses one multi-get request per chunk of documents.
+
+    Parameters
+    ----------
+    docs : iterable over dict
+        Handles returned by es_document. Their field is ignored.
+
+    Returns
+    -------
+    results : list of dict
+        For each document, a (possibly empty) {taskname : data} dict.
+    """
+    results = []
+    for chunk in partition_all(chunk_size, docs):
+        body = {'docs': [{'_index': doc['index'], '_type': doc['type'],
+                          '_id': doc['id'], '_source': ['xtas_results']}
+                         for doc in chunk]}
+        for r in _es().mget(body=body)['docs']:
+            stored = r.get('_source', {}).get('xtas_results', {})
+            results.append({k: v['data'] for k, v in iteritems(stored)})
+    return results
+
+
 def get_single_result(taskname, idx, typ, id):
     """Get a single xtas result"""
     r = get_all_results(idx, typ, id)
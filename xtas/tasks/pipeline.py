@@ -2,53 +2,81 @@
 Pipelining with partial caching
 """
 
+from collections import defaultdict, deque
+from itertools import groupby
+
 import celery
+from celery import states
+from celery.exceptions import TimeoutError
+from celery.result import ResultSet
+from toolz import partition_all
 
-from xtas.tasks.es import _ES_DOC_FIELDS, get_all_results, store_single, fetch
+from xtas.tasks.cache import (CachedTask, cache_result, content_key,
+                              get_cache, stage_keys)
+from xtas.tasks.es import (_ES_DOC_FIELDS, _is_es_document, get_all_results,
+                           get_many_results, fetch, fetch_many,
+                           store_buffered, store_single)
 from xtas.core import app
+from xtas._utils import tosequence
 
 
 def pipeline(doc, pipeline, store_final=True, store_intermediate=False,
-             block=True):
+             block=True, buffered=False, fused=False):
     """
     Get the result for a given document.
     Pipeline should be a list of dicts, with members task and argument
     e.g. [{"module" : "tokenize"},
           {"module" : "pos_tag", "arguments" : {"model" : "nltk"}}]
+    A dict may also have a member "version"; changing it invalidates cached
+    results of the task (and its successors). See cache.stage_keys.
+    If doc is a string and a RESULT_CACHE is configured, results are cached
+    by the content of doc; otherwise, doc should be an ES document handle
+    for caching to take place.
     @param block: if True, it will block and return the actual result.
                   If False, it will return an AsyncResult unless the result was
                   cached, in which case it returns the result immediately (!)
     @param store_final: if True, store the final result
     @param store_intermediate: if True, store all intermediate results as well
+    @param buffered: if True, results are stored through the worker's bulk
+                     writer (see store_buffered) instead of one update
+                     request each. They may take a few seconds to appear.
+    @param fused: if True, consecutive tasks (including store commands) are
+                  run in-process by a single worker, without passing
+                  intermediate results through the broker, except for tasks
+                  marked fusable=False (e.g., those needing a dedicated
+                  worker). See run_fused.
     """
     # form basic pipeline by resolving task dictionaries to task objects
     tasks = [_get_task(t) for t in pipeline]
+    store = store_buffered if buffered else store_single
 
-    if isinstance(doc, dict) and set(doc.keys()) == set(_ES_DOC_FIELDS):
+    if _is_es_document(doc):
         idx, typ, id, field = [doc[k] for k in _ES_DOC_FIELDS]
-        chain = []
-        input = None
         cache = get_all_results(idx, typ, id)
-        # Check cache for existing documents
-        # Iterate over tasks in reverse order, check cached result, and
-        # otherwise prepend task (and cache store command) to chain
-        for i in range(len(tasks), 0, -1):
-            taskname = "__".join(t.task for t in tasks[:i])
-            if taskname in cache:
-                input = cache[taskname]
-                break
-            if (i == len(tasks) and store_final) or store_intermediate:
-                chain.insert(0, store_single.s(taskname, idx, typ, id))
-            chain.insert(0, tasks[i-1])
+        keys = _cache_keys(pipeline, tasks)
+        _, chain, input = _cached_chain(tasks, keys, cache,
+                                        _es_store(store, doc),
+                                        store_final, store_intermediate)
         if not chain:  # final result was cached, good!
             return input
         elif input is None:
             input = fetch(doc)
+    elif isinstance(doc, basestring) and get_cache() is not None:
+        _, chain, input = _content_cached_chain(tasks,
+                                                _cache_keys(pipeline, tasks),
+                                                doc, store_final,
+                                                store_intermediate)
+        if not chain:
+            return input
+        elif input is None:
+            input = doc
     else:
-        # the doc is a string, so we can't use caching
+        # the doc is not a handle or string, so we can't use caching
         chain = tasks
         input = doc
 
+    if fused:
+        chain = _fuse(chain)
     chain = celery.chain(*chain).delay(input)
     if block:
         return chain.get()
@@ -56,6 +84,226 @@ def pipeline(doc, pipeline, store_final=True, store_intermediate=False,
         return chain
 
 
+def pipeline_batch(docs, pipeline, store_final=True, store_intermediate=False,
+                   buffered=False, fused=False, chunk_size=100,
+                   max_groups=10, poll_interval=1.):
+    """
+    Run a pipeline over many documents.
+    Like pipeline, but the cache is probed for all ES documents with bulk
+    requests, documents whose cached results end at the same stage are
+    dispatched together as Celery groups of (at most) chunk_size chains,
+    and uncached documents are fetched in bulk.
+    Generates (i, result) pairs, where i is the position of the document in
+    docs. Cached results come first, then the results of each group, as
+    groups complete. If the pipeline failed for a document, its result is
+    the exception that was raised.
+    @param chunk_size: number of documents to dispatch in one group
+    @param max_groups: maximum number of groups to have in progress; the
+                       next group is dispatched when the oldest completes
+    @param poll_interval: seconds without results from a group after which
+                          its chains are checked for failures earlier in
+                          the pipeline
+    For the other parameters, see pipeline.
+    """
+    tasks = [_get_task(t) for t in pipeline]
+    keys = _cache_keys(pipeline, tasks)
+    store = store_buffered if buffered else store_single
+    docs = tosequence(docs)
+
+    handles = [i for i, doc in enumerate(docs) if _is_es_document(doc)]
+    caches = dict(zip(handles, get_many_results(docs[i] for i in handles)))
+
+    # Documents to process, grouped by the number of cached stages.
+    todo = defaultdict(list)
+    content_cache = get_cache()
+    for i, doc in enumerate(docs):
+        if i in caches:
+            stage, chain, input = _cached_chain(tasks, keys, caches[i],
+                                                _es_store(store, doc),
+                                                store_final,
+                                                store_intermediate)
+        elif isinstance(doc, basestring) and content_cache is not None:
+            stage, chain, input = _content_cached_chain(tasks, keys, doc,
+                                                        store_final,
+                                                        store_intermediate)
+        else:
+            stage, chain = 0, tasks
+        if not chain:
+            yield i, input
+            continue
+        if fused:
+            chain = _fuse(chain)
+        if stage == 0:
+            input = doc     # ES documents are fetched in bulk when dispatched
+        todo[stage].append((i, chain, input))
+
+    in_flight = deque()
+    for stage in sorted(todo):
+        for chunk in partition_all(chunk_size, todo[stage]):
+            if len(in_flight) >= max_groups:
+                for r in _collect(in_flight.popleft(), poll_interval):
+                    yield r
+
+            indices, chains, inputs = zip(*chunk)
+            if stage == 0:
+                inputs = _fetch_handles(inputs)
+            group = celery.group(_bind_chain(chain, input)
+                                 for chain, input in zip(chains, inputs))
+            in_flight.append(zip(indices, group.apply_async().results))
+
+    while in_flight:
+        for r in _collect(in_flight.popleft(), poll_interval):
+            yield r
+
+
+@app.task
+def run_fused(doc, tasks):
+    """
+    Run a chain of tasks in the current process.
+    tasks should be a list of (serialized) signatures, which are called in
+    order, each on the result of the previous one; the first is called on
+    doc. Returns the result of the last task.
+    """
+    for t in tasks:
+        doc = app.tasks[t['task']](doc, *t['args'], **t['kwargs'])
+    return doc
+
+
+def _fusable(task):
+    "Whether the task signature can be run by run_fused"
+    return (getattr(app.tasks[task.task], 'fusable', True)
+            and 'queue' not in task.options)
+
+
+def _fuse(chain):
+    """
+    Replace runs of fusable tasks in chain by run_fused signatures.
+    """
+    fused = []
+    for fusable, tasks in groupby(chain, _fusable):
+        tasks = list(tasks)
+        if fusable and len(tasks) > 1:
+            fused.append(run_fused.s(tasks))
+        else:
+            fused.extend(tasks)
+    return fused
+
+
+def _fetch_handles(docs):
+    "Fetch the ES documents among docs in bulk, leaving other docs as-is"
+    fetched = fetch_many(doc for doc in docs if _is_es_document(doc))
+    return [next(fetched) if _is_es_document(doc) else doc for doc in docs]
+
+
+def _bind_chain(tasks, input):
+    "Make a chain of (copies of) tasks that takes input as its argument"
+    # Signatures are copied since Celery assigns task ids to them.
+    head = tasks[0].clone((input,))
+    return celery.chain(head, *[t.clone() for t in tasks[1:]])
+
+
+def _collect(pending, interval):
+    """
+    Wait for the chains of a group, given (i, AsyncResult) pairs for them,
+    generating (i, result) pairs, where the result of a failed chain is the
+    exception that it raised.
+    Results are collected with a single bulk operation where the result
+    backend supports it (see ResultSet.join_native). When a task in a chain
+    fails, the tasks after it never run, so when no chain completed in the
+    last interval seconds, the chains not yet done are checked for failed
+    tasks.
+    """
+    pending = dict((r.id, (i, r)) for i, r in pending)
+    while pending:
+        done = []
+        try:
+            ResultSet([r for _, r in pending.values()]).get(
+                timeout=interval, interval=interval, propagate=False,
+                callback=lambda id, value: done.append((id, value)))
+        except TimeoutError:
+            pass
+        for id, value in done:
+            yield pending.pop(id)[0], value
+        if done:
+            continue
+
+        for id, (i, r) in list(pending.items()):
+            failed = _failed_parent(r)
+            if failed is not None:
+                del pending[id]
+                yield i, failed.result
+
+
+def _failed_parent(result):
+    """
+    The failed (or revoked) task before result in its chain, if any.
+    The tasks after such a task never run, and the tasks before a successful
+    one have succeeded, so this looks back only as far as the last task
+    that is done.
+    """
+    parent = result.parent
+    while parent is not None:
+        state = parent.state
+        if state in states.READY_STATES:
+            return parent if state in states.PROPAGATE_STATES else None
+        parent = parent.parent
+    return None
+
+
+def _cached_chain(tasks, keys, cache, store, store_final,
+                  store_intermediate):
+    """
+    Build the chain of tasks (and store commands) that remains, given cached
+    results (a dict) and the cache keys of the prefixes of tasks. store
+    should map a cache key to a signature that stores a result under it, or
+    None if the result is stored already.
+    Returns (stage, chain, input), where stage is the number of tasks whose
+    result was cached and input is the cached result of the last of those,
+    or None if stage is 0.
+    """
+    chain = []
+    # Iterate over tasks in reverse order, check cached result, and
+    # otherwise prepend task (and cache store command) to chain
+    for i in range(len(tasks), 0, -1):
+        taskname = keys[i-1]
+        if taskname in cache:
+            return i, chain, cache[taskname]
+        if (i == len(tasks) and store_final) or store_intermediate:
+            store_sig = store(taskname)
+            if store_sig is not None:
+                chain.insert(0, store_sig)
+        chain.insert(0, tasks[i-1])
+    return 0, chain, None
+
+
+def _content_cached_chain(tasks, keys, text, store_final,
+                          store_intermediate):
+    "_cached_chain for a plain text, using the content-addressed cache"
+    keys = [content_key(text, k) for k in keys]
+    # A CachedTask stores its result on text itself, under the first key
+    # unless the pipeline gives the task a version.
+    stored = None
+    if isinstance(app.tasks[tasks[0].task], CachedTask):
+        stored = content_key(text, stage_keys(tasks[:1])[0])
+
+    def store(key):
+        return None if key == stored else cache_result.s(key)
+
+    return _cached_chain(tasks, keys, get_cache().get_many(keys), store,
+                         store_final, store_intermediate)
+
+
+def _es_store(store, doc):
+    "Make the store argument to _cached_chain for an ES document"
+    idx, typ, id, field = [doc[k] for k in _ES_DOC_FIELDS]
+    return lambda taskname: store.s(taskname, idx, typ, id)
+
+
+def _cache_keys(pipeline, tasks):
+    "Cache keys for all prefixes of a pipeline; see cache.stage_keys"
+    return stage_keys(tasks, [t.get('version') for t in pipeline])
+
+
 def _get_task(task_dict):
     "Create a celery task object from a dictionary with module and arguments"
     task = task_dict['module']
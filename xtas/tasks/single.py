@@ -4,10 +4,17 @@ These tasks process one document at a time. Usually, a document is passed as
 the first argument; it may either be a string or the result from
 ``xtas.tasks.es.es_document``, which is a reference to a document in the
 Elasticsearch store.
+
+Tasks that take a document cache their results on string input when a
+RESULT_CACHE is configured; see ``xtas.tasks.cache``. Tasks that wrap
+heavyweight external tools, and are typically given their own workers, are
+marked ``fusable=False`` so that pipelines never run them in-process with
+other tasks (see ``xtas.tasks.pipeline.run_fused``).
 """
 
 from __future__ import absolute_import
 
+from functools import partial
 import json
 
 from six.moves.urllib.parse import urlencode
@@ -17,12 +24,13 @@ import nltk
 import spotlight
 from toolz import identity, pipe
 
+from .cache import CachedTask
 from .es import fetch
 from ..core import app
-from .._utils import nltk_download
+from .._utils import nltk_resource
 
 
-@app.task
+@app.task(base=CachedTask)
 def guess_language(doc, output="best"):
     """Guess the language of a document.
 
@@ -47,7 +55,7 @@ def guess_language(doc, output="best"):
     return func(fetch(doc))
 
 
-@app.task
+@app.task(base=CachedTask)
 def morphy(doc):
     """Lemmatize tokens using morphy, WordNet's lemmatizer.
 
@@ -60,17 +68,26 @@ def morphy(doc):
     """
     # XXX Results will be better if we do POS tagging first, but then we
     # need to map Penn Treebank tags to WordNet tags.
-    nltk_download('wordnet')
-    return map(nltk.WordNetLemmatizer().lemmatize,
-               _tokenize_if_needed(fetch(doc)))
-
-
-@app.task
+    lemmatize = nltk_resource('lemmatizer').lemmatize
+    lemmas = {}     # tokens tend to recur within a document
+    result = []
+    for token in _tokenize_if_needed(fetch(doc)):
+        try:
+            lemma = lemmas[token]
+        except KeyError:
+            lemma = lemmas[token] = lemmatize(token)
+        result.append(lemma)
+    return result
+
+
+@app.task(base=CachedTask)
 def movie_review_polarity(doc):
     """Movie review polarity classifier.
 
     Runs a logistic regression model trained on a set of positive and negative
-    movie reviews (all in English).
+    movie reviews (all in English). The model must be built first, with
+    ``python -m xtas.tasks._polarity``. To classify many documents, use
+    ``movie_review_polarity_batch``, which is much faster.
 
     Returns
     -------
@@ -78,14 +95,14 @@ def movie_review_polarity(doc):
         The probability that the movie review ``doc`` is positive.
     """
     from ._polarity import classify
-    return classify(doc)
+    return classify(fetch(doc))
 
 
 def _tokenize_if_needed(s):
     return tokenize(s) if isinstance(s, basestring) else s
 
 
-@app.task
+@app.task(base=CachedTask)
 def stanford_ner_tag(doc, output="tokens"):
     """Named entity recognizer using Stanford NER.
 
@@ -125,11 +142,10 @@ def pos_tag(tokens, model='nltk'):
     """
     if model != 'nltk':
         raise ValueError("unknown POS tagger %r" % model)
-    nltk_download('maxent_treebank_pos_tagger')
-    return nltk.pos_tag(tokens)
+    return nltk_resource('pos_tagger').tag(tokens)
 
 
-@app.task
+@app.task(base=CachedTask)
 def sentiwords_tag(doc, output="bag"):
     """Tag doc with SentiWords polarity priors.
 
@@ -171,7 +187,7 @@ def sentiwords_tag(doc, output="bag"):
         raise ValueError("unknown output format %r" % output)
 
 
-@app.task
+@app.task(base=CachedTask)
 def tokenize(doc):
     """Tokenize text.
 
@@ -181,7 +197,7 @@ def tokenize(doc):
     return nltk.word_tokenize(text)
 
 
-@app.task
+@app.task(base=CachedTask)
 def semanticize(doc, lang='en'):
     """Run text through the UvA semanticizer.
 
@@ -219,11 +235,12 @@ def untokenize(tokens):
     return ' '.join(tokens)
 
 
-@app.task
+@app.task(base=CachedTask)
 def frog(doc, output='raw'):
     """Wrapper around the Frog lemmatizer/POS tagger/NER/dependency parser.
 
-    Expects Frog to be running in server mode at localhost:9887. It is *not*
+    Expects Frog to be running in server mode at localhost:9887, or at the
+    servers configured by FROG (see ``xtas.core.configure``). It is *not*
     started for you.
 
     Currently, the module is only tested with all frog modules active except
@@ -239,28 +256,26 @@ def frog(doc, output='raw'):
         If 'raw', returns the raw output lines from Frog itself.
         If 'tokens', returns dictionaries for the tokens.
         If 'saf', returns a SAF dictionary.
+        If 'table', returns a dictionary with a list per token attribute:
+        word, lemma, pos, pos_confidence, ne (None outside named entities),
+        head (index of the parent in the sentence, -1 for the root),
+        relation and sentence. This is the most compact format.
 
     References
     ----------
     `Frog homepage <http://ilk.uvt.nl/frog/>`_
     """
-    from ._frog import call_frog, parse_frog, frog_to_saf
-    if output not in ('raw', 'tokens', 'saf'):
+    from ._frog import call_frog, convert
+    if output not in ('raw', 'tokens', 'saf', 'table'):
         raise ValueError("Uknown output: {output}, "
-                         "please choose either raw, tokens, or saf"
+                         "please choose either raw, tokens, saf or table"
                          .format(**locals()))
     text = fetch(doc)
-    result = call_frog(text)
-    if output == 'raw':
-        return list(result)
-    if output in ('tokens', 'saf'):
-        result = parse_frog(result)
-        if output == 'tokens':
-            return list(result)
-        return frog_to_saf(result)
+    # The output is parsed as it is read from the connection.
+    return convert(call_frog(text), output)
 
 
-@app.task
+@app.task(base=CachedTask)
 def dbpedia_spotlight(doc, lang='en', conf=0.5, supp=0, api_url=None):
     """Run text through a DBpedia Spotlight instance.
 
@@ -317,7 +332,7 @@ def dbpedia_spotlight(doc, lang='en', conf=0.5, supp=0, api_url=None):
     return annotations
 
 
-@app.task
+@app.task(base=CachedTask, fusable=False)
 def alpino(doc, output="raw"):
     """Wrapper around the Alpino (dependency) parser for Dutch.
 
@@ -347,7 +362,7 @@ def alpino(doc, output="raw"):
     return pipe(doc, fetch, tokenize, parse_raw, transf)
 
 
-@app.task
+@app.task(base=CachedTask, fusable=False)
 def corenlp(doc, output='raw'):
     """Wrapper around the CoreNLP parser.
 
@@ -371,7 +386,7 @@ def corenlp(doc, output='raw'):
     return pipe(doc, fetch, parse, transf)
 
 
-@app.task
+@app.task(base=CachedTask, fusable=False)
 def corenlp_lemmatize(doc, output='raw'):
 
     """
@@ -387,22 +402,25 @@ def corenlp_lemmatize(doc, output='raw'):
     Tested with
     http://nlp.stanford.edu/software/stanford-corenlp-full-2014-01-04.zip
     """
-    from ._corenlp import parse, stanford_to_saf
+    from ._corenlp import LEMMATIZE_ANNOTATORS, parse, stanford_to_saf
 
     try:
         transf = {"raw": identity, "saf": stanford_to_saf}[output]
     except KeyError:
         raise ValueError("Unknown output format %r" % output)
 
-    return pipe(doc, fetch, parse, transf)
+    return pipe(doc, fetch, partial(parse, annotators=LEMMATIZE_ANNOTATORS),
+                transf)
 
 
-@app.task
+@app.task(fusable=False)
 def semafor(saf):
     """Wrapper around the Semafor semantic parser.
 
-    Expects semafor running in server mode listening to
-    SEMAFOR_HOST:SEMAFOR_PORT (defaults to localhost:9888).
+    Expects SEMAFOR_HOME and MALT_MODEL_DIR to point to the Semafor
+    installation and its Malt model, respectively; see ``xtas.tasks._semafor``.
+    Semafor processes are kept running in a pool configured by SEMAFOR
+    (see ``xtas.core.configure``).
     It also expects CORENLP_HOME to point to the CoreNLP installation dir.
 
     Input is expected to be a 'SAF' dictionary with trees and tokens.
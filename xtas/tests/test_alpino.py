@@ -7,7 +7,7 @@ import os.path
 import logging
 from unittest import SkipTest
 
-from nose.tools import assert_equal, assert_not_equal, assert_in
+from nose.tools import assert_equal, assert_not_equal, assert_in, assert_true
 
 from xtas.tasks._alpino import (tokenize, parse_raw,
                                 interpret_token, interpret_parse)
@@ -45,6 +45,18 @@ def test_parse():
                  {dep for dep in _PARSE.split("\n") if dep})
 
 
+def test_parse_persistent():
+    "Repeated parses should be served by the same Alpino process"
+    _check_alpino()
+    from xtas.tasks._alpino import AlpinoParser
+    parse_raw(_SENT)
+    process = AlpinoParser.get_singleton().process
+    deps = parse_raw(_SENT + "\n" + _SENT)
+    assert_equal({dep.rsplit("|", 1)[-1] for dep in deps.split("\n") if dep},
+                 {"1", "2"})
+    assert_true(AlpinoParser.get_singleton().process is process)
+
+
 def test_interpret_token():
     actual = interpret_token(*_TOK_TOOB.split("|"))
     expected = {'lemma': 'Toob', 'word': 'Toob', 'offset': 0,
@@ -1,8 +1,11 @@
 # Tests for batch operations.
-from nose.tools import assert_equal
+from nose.tools import assert_almost_equal, assert_equal
 
 from xtas.tasks.cluster import (big_kmeans, kmeans, lda, lsa,
+                                movie_review_polarity_batch,
                                 parsimonious_wordcloud)
+from xtas.tasks.single import movie_review_polarity
+from xtas.tests.test_single import build_polarity_model
 
 
 # The clusters in these should be obvious.
@@ -26,6 +29,13 @@ def test_kmeans():
     assert_equal(DOCS, sorted(clusters[0] + clusters[1] + clusters[2]))
 
 
+def test_big_kmeans_batches():
+    # Small batches, labels from a second pass.
+    clusters = big_kmeans(DOCS, 2, batch_size=2, single_pass=False)
+    assert_equal(len(clusters), 2)
+    assert_equal(DOCS, sorted(clusters[0] + clusters[1]))
+
+
 def test_topic_models():
     n_topics = 3
     for estimator in [lda, lsa]:
@@ -39,3 +49,12 @@ def test_wordcloud():
     cloud = parsimonious_wordcloud([doc.split() for doc in DOCS])
     assert_equal(len(cloud), len(DOCS))
     assert_equal(len(cloud[0]), 10)
+
+
+def test_movie_review_polarity_batch():
+    build_polarity_model()
+    reviews = ["This movie sucks.", "A great film, I loved it."]
+    probs = movie_review_polarity_batch(reviews)
+    assert_equal(len(probs), len(reviews))
+    for review, p in zip(reviews, probs):
+        assert_almost_equal(p, movie_review_polarity(review))
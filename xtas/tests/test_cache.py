@@ -0,0 +1,116 @@
+"""
+Test the content-addressed result cache
+"""
+
+from contextlib import contextmanager
+import os.path
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true
+
+from xtas.tasks.cache import (LRUCache, ResultCache, SQLiteStore,
+                              content_key, get_cache)
+
+
+@contextmanager
+def result_cache(**config):
+    "Enable the result cache, with an SQLite file in a temporary directory"
+    from xtas.core import _config
+    tempdir = tempfile.mkdtemp()
+    config.setdefault('path', os.path.join(tempdir, 'cache.sqlite'))
+    old = _config.get('RESULT_CACHE')
+    _config['RESULT_CACHE'] = config
+    try:
+        yield get_cache()
+    finally:
+        _config['RESULT_CACHE'] = old
+        shutil.rmtree(tempdir)
+
+
+def test_lru():
+    lru = LRUCache(2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert_equal(lru.get("a"), 1)
+    lru.set("c", 3)     # evicts b, which was used least recently
+    assert_equal(lru.get("b"), None)
+    assert_equal(lru.get("a"), 1)
+    assert_equal(lru.get("c"), 3)
+
+
+def test_two_tiers():
+    with result_cache() as cache:
+        store = cache.backend
+        assert_true(isinstance(store, SQLiteStore))
+
+        cache.set("key", [("cats", "NNS")])
+        assert_equal(cache.get("key"), [["cats", "NNS"]])
+        assert_equal(store.get("key"), '[["cats", "NNS"]]')
+
+        # a second process would only see the shared tier
+        other = ResultCache(backend=SQLiteStore(store.path))
+        assert_equal(other.get_many(["key", "other"]),
+                     {"key": [["cats", "NNS"]]})
+
+
+def test_content_key():
+    assert_equal(content_key(u"caf\xe9", "stage"),
+                 content_key(u"caf\xe9".encode("utf-8"), "stage"))
+    assert_true(content_key("a", "stage") != content_key("b", "stage"))
+    assert_true(content_key("a", "stage") != content_key("a", "other"))
+
+
+def test_cached_task():
+    from xtas.tasks.cache import stage_keys
+    from xtas.tasks.single import guess_language
+    text = "Three quarks for muster Mark"
+    key = content_key(text, stage_keys([guess_language.s()])[0])
+    with result_cache() as cache:
+        result = guess_language(text)
+        assert_equal(cache.get(key), list(result))
+
+        # a (fake) cached result should be returned without running the task
+        cache.set(key, ["xx", 1.])
+        assert_equal(guess_language(text), ["xx", 1.])
+        assert_equal(guess_language(text, output="rank")[0][0], "en")
+
+
+def test_sqlite_limits():
+    import time
+    with result_cache() as cache:
+        store = SQLiteStore(cache.backend.path, max_size=2, prune_every=3)
+        for key in "abc":
+            store.set(key, key)
+        # pruned after the third write, keeping the two newest
+        assert_equal([store.get(key) for key in "abc"], [None, "b", "c"])
+
+        store.ttl = 60
+        assert_equal(store.get("c"), "c")
+        store.ttl = 0
+        time.sleep(.01)
+        assert_equal(store.get("c"), None)
+        store.prune()
+        store.ttl = None
+        assert_equal(store.get("c"), None)
+
+
+def test_pipeline_stores_once():
+    "Results of a CachedTask are not stored again by the pipeline"
+    from xtas.tasks.pipeline import (_cache_keys, _content_cached_chain,
+                                     _get_task)
+    text = "Three quarks for muster Mark"
+    for pipe in [[{"module": "xtas.tasks.single.guess_language"}],
+                 [{"module": "xtas.tasks.single.guess_language",
+                   "version": 2}]]:
+        tasks = [_get_task(t) for t in pipe]
+        with result_cache():
+            _, chain, _ = _content_cached_chain(
+                tasks, _cache_keys(pipe, tasks), text, True, True)
+        tasknames = [t.task for t in chain]
+        if "version" in pipe[0]:
+            # different key from the task's own
+            assert_equal(tasknames, [tasks[0].task,
+                                     "xtas.tasks.cache.cache_result"])
+        else:
+            assert_equal(tasknames, [tasks[0].task])
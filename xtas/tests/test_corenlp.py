@@ -2,12 +2,16 @@
 Test the CoreNLP parser/lemmatizer functions and task.
 """
 
+from contextlib import contextmanager
 import logging
 from unittest import SkipTest
 
 from nose.tools import assert_equal, assert_not_equal
 
-from xtas.tasks._corenlp import parse, stanford_to_saf, get_corenlp_version
+from xtas.tasks._corenlp import (CoreNLPPool, StanfordCoreNLP, parse,
+                                 parse_many, stanford_to_saf,
+                                 get_corenlp_version, _parse_memory,
+                                 _split_documents)
 from xtas.tasks.single import corenlp, corenlp_lemmatize
 
 
@@ -17,6 +21,176 @@ def _check_corenlp():
         raise SkipTest("CoreNLP not found at CORENLP_HOME")
 
 
+class _FakeProcess(object):
+    "Stands in for a StanfordCoreNLP object"
+    returncode = None
+
+    def __init__(self):
+        self.corenlp_process = self
+
+    def poll(self):
+        return self.returncode
+
+    def start_corenlp(self):
+        self.returncode = None
+
+
+class _FakePool(CoreNLPPool):
+    def _start_process(self):
+        return _FakeProcess()
+
+
+def test_pool():
+    import threading
+
+    pool = _FakePool(size=2)
+    a, b = pool.checkout(), pool.checkout()
+    assert_not_equal(a, b)
+
+    # A third caller must wait until a process is checked in.
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.checkout()))
+    t.start()
+    t.join(.1)
+    assert_equal(got, [])
+    a.returncode = 1    # died; should be restarted at checkout
+    pool.checkin(a)
+    t.join()
+    assert_equal(got, [a])
+    assert_equal(a.poll(), None)
+
+    pool.checkin(b)
+    with pool.process() as p:
+        assert_equal(p, b)
+    assert_equal(pool.checkout(), b)
+
+
+def test_pool_failed_restart():
+    import threading
+
+    class BrokenProcess(_FakeProcess):
+        def start_corenlp(self):
+            raise OSError("cannot restart")
+
+    class BrokenPool(CoreNLPPool):
+        def _start_process(self):
+            return BrokenProcess()
+
+    pool = BrokenPool(size=1)
+    a = pool.checkout()
+    a.returncode = 1
+    pool.checkin(a)
+    try:
+        pool.checkout()
+    except OSError:
+        pass
+    else:
+        raise AssertionError("restart should have failed")
+
+    # The failed process's slot must be freed, so a new one gets started
+    # instead of the next caller waiting forever.
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.checkout()))
+    t.daemon = True
+    t.start()
+    t.join(1)
+    assert_equal(len(got), 1)
+    assert_not_equal(got[0], a)
+
+
+def test_pool_warm_up():
+    pool = _FakePool(size=3)
+    pool.warm_up(1, wait=True)
+    assert_equal(len(pool._idle), 1)
+    pool.warm_up(wait=True)
+    assert_equal(len(pool._idle), 3)
+    a, b = pool.checkout(), pool.checkout()
+    assert_equal(pool._started, 3)
+    pool.warm_up()      # nothing left to start
+    assert_equal(pool._started, 3)
+
+
+# Mimics the CoreNLP shell: a prompt on stderr before reading each line,
+# blank lines included, and a "parse" of non-blank lines on stdout.
+_FAKE_SHELL = r"""
+import sys
+
+def prompt():
+    sys.stderr.write("NLP> ")
+    sys.stderr.flush()
+
+prompt()
+for line in iter(sys.stdin.readline, ""):
+    words = line.split()
+    if words:
+        sys.stdout.write("Sentence #1 (%d tokens):\n%s\n%s\n\n"
+                         % (len(words), " ".join(words),
+                            " ".join("[Text=%s]" % w for w in words)))
+        sys.stdout.flush()
+    prompt()
+"""
+
+
+class _FakeShell(StanfordCoreNLP):
+    def _command(self):
+        import pipes
+        import sys
+        return "%s -c %s" % (sys.executable, pipes.quote(_FAKE_SHELL))
+
+
+@contextmanager
+def _interrupt_reads():
+    "Make the first read from CoreNLP raise KeyboardInterrupt"
+    from xtas.tasks import _corenlp
+    read_chunk = _corenlp._read_chunk
+
+    def interrupt(fd):
+        _corenlp._read_chunk = read_chunk
+        raise KeyboardInterrupt()
+
+    _corenlp._read_chunk = interrupt
+    try:
+        yield
+    finally:
+        _corenlp._read_chunk = read_chunk
+
+
+def test_communicate():
+    p = _FakeShell()
+    try:
+        expected = ['Sentence #1 (2 tokens):', 'It works',
+                    '[Text=It] [Text=works]', '']
+        # Each call should wait for its own output, not return on prompts
+        # left over from the previous one.
+        for _ in range(3):
+            assert_equal(p.parse("It works"), expected)
+            assert_equal(p.parse(""), [])
+
+        texts = ["It works", "", "Cool"]
+        assert_equal(p.parse_many(texts), [p.parse(t) for t in texts])
+        assert_equal(p.parse_many([]), [])
+
+        # An interrupted call leaves output behind, so the process should
+        # be killed and respawned rather than reused.
+        process = p.corenlp_process
+        with _interrupt_reads():
+            try:
+                p.parse("Interrupted")
+            except KeyboardInterrupt:
+                pass
+        assert_not_equal(process.poll(), None)
+        assert_equal(p.parse("It works"), expected)
+        assert_not_equal(p.corenlp_process, process)
+    finally:
+        p.corenlp_process.kill()
+        p.corenlp_process.wait()
+
+
+def test_parse_memory():
+    assert_equal(_parse_memory("3G"), 3 * 2 ** 30)
+    assert_equal(_parse_memory("512m"), 512 * 2 ** 20)
+
+
 def test_raw():
     _check_corenlp()
     lines = parse("It. Works\n", annotators=['tokenize', 'ssplit'])
@@ -28,6 +202,30 @@ def test_raw():
     assert_equal(lines, expected)
 
 
+def test_split_documents():
+    sep = ['Sentence #1 (1 tokens):', 'xtasdocumentseparator',
+           '[Text=xtasdocumentseparator]', '']
+    doc1 = ['Sentence #1 (1 tokens):', 'It', '[Text=It]', '',
+            'Sentence #2 (1 tokens):', 'Works', '[Text=Works]', '']
+    doc2 = ['Sentence #1 (1 tokens):', 'Cool', '[Text=Cool]', '']
+    assert_equal(_split_documents(doc1 + sep + doc2 + sep), [doc1, doc2])
+
+
+def test_parse_many():
+    _check_corenlp()
+    annotators = ['tokenize', 'ssplit', 'pos', 'lemma']
+    texts = ["It. Works", "", "He jumped."]
+    results = parse_many(texts, annotators=annotators)
+    assert_equal(results[0], parse(texts[0], annotators=annotators))
+    assert_equal(results[1], [])
+    assert_equal(results[2], parse(texts[2], annotators=annotators))
+
+    from xtas.tasks.cluster import corenlp_batch
+    safs = corenlp_batch(texts, output='saf', annotators=annotators)
+    assert_equal({t['lemma'] for t in safs[2]['tokens']},
+                 {'he', 'jump', '.'})
+
+
 def test_lemmatize():
     _check_corenlp()
     lines = parse("He jumped. \n\n Cool!",
@@ -90,3 +288,45 @@ def test_task():
     assert_equal(set(raw[-3:]), deps)
     saf = corenlp("It works", output='saf')
     assert_equal(len(saf['dependencies']), 1)
+
+
+def test_stanford_to_saf():
+    # Doesn't need CoreNLP.
+    lines = ["Sentence #1 (3 tokens):",
+             "John loves himself",
+             "[Text=John CharacterOffsetBegin=0 CharacterOffsetEnd=4"
+             " PartOfSpeech=NNP Lemma=John NamedEntityTag=PERSON]"
+             " [Text=loves CharacterOffsetBegin=5 CharacterOffsetEnd=10"
+             " PartOfSpeech=VBZ Lemma=love NamedEntityTag=O Flag]"
+             " [Text=himself CharacterOffsetBegin=11 CharacterOffsetEnd=18"
+             " PartOfSpeech=PRP Lemma=himself NamedEntityTag=O]",
+             "(ROOT",
+             "(S",
+             "(NP (NNP John))",
+             "(VP (VBZ loves)",
+             "(NP (PRP himself)))))",
+             "",
+             "root(ROOT-0, loves-2)",
+             "nsubj(loves-2, John-1)",
+             "dobj(loves-2, himself-3)",
+             "",
+             "Sentence #2 (1 tokens):",
+             "=",
+             "[Text== CharacterOffsetBegin=19 CharacterOffsetEnd=20"
+             " PartOfSpeech=SYM Lemma==]",
+             "Coreference set:",
+             '(1,3,[3,4)) -> (1,1,[1,2)), that is: "himself" -> "John"']
+    saf = stanford_to_saf(lines)
+    assert_equal([(t['id'], t['lemma'], t['sentence']) for t in saf['tokens']],
+                 [(1, 'John', 1), (2, 'love', 1), (3, 'himself', 1),
+                  (4, '=', 2)])
+    assert_equal(saf['entities'], [{'tokens': [1], 'type': 'PERSON'}])
+    assert_equal(saf['trees'], [{
+        "tree": "(ROOT (S (NP (NNP John)) (VP (VBZ loves) "
+                "(NP (PRP himself)))))",
+        "sentence": 1
+        }])
+    assert_equal(saf['dependencies'],
+                 [{'child': 1, 'parent': 2, 'relation': 'nsubj'},
+                  {'child': 3, 'parent': 2, 'relation': 'dobj'}])
+    assert_equal(saf['coreferences'], [[[3], [1]]])
@@ -1,4 +1,4 @@
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true
 from unittest import SkipTest
 import logging
 from contextlib import contextmanager
@@ -30,11 +30,75 @@ def clean_es():
         indexclient.delete(ES_TEST_INDEX)
 
 
+def test_client_reuse():
+    "The ES client should be created once per process and configuration"
+    from xtas.core import _config
+    from xtas.tasks.es import _es
+    assert_true(_es() is _es())
+
+    old = _config['ELASTICSEARCH']
+    _config['ELASTICSEARCH'] = {'hosts': old, 'timeout': 42}
+    try:
+        es = _es()
+        assert_true(es is _es())
+    finally:
+        _config['ELASTICSEARCH'] = old
+    assert_true(es is not _es())
+
+
+class _FakeBulkClient(object):
+    "Answers bulk requests, failing the update of document 'bad'"
+    def __init__(self, fail_request=False):
+        from elasticsearch.serializer import JSONSerializer
+        self.fail_request = fail_request
+        self.transport = self
+        self.serializer = JSONSerializer()
+
+    def bulk(self, body, **kwargs):
+        from elasticsearch.exceptions import TransportError
+        if self.fail_request:
+            raise TransportError(503, "unavailable")
+        actions = [self.serializer.loads(ln)
+                   for ln in body.strip().split("\n")][::2]
+        items = []
+        for a in actions:
+            item = dict(a['update'], status=200)
+            if item['_id'] == 'bad':
+                item.update(status=404, error={'type': 'not_found',
+                                               'reason': 'missing'})
+            items.append({'update': item})
+        return {'errors': True, 'items': items}
+
+
+def test_store_many_failures():
+    "Failures should be reported in a JSON-serializable form"
+    import json
+    from xtas.tasks import es
+
+    items = [("task", "idx", "typ", id, "result") for id in ["ok", "bad"]]
+    old = es._es
+    try:
+        es._es = lambda: _FakeBulkClient()
+        failures = es.store_many(items)
+        assert_equal([(f['_id'], f['status']) for f in failures],
+                     [("bad", 404)])
+        json.dumps(failures)
+
+        es._es = lambda: _FakeBulkClient(fail_request=True)
+        failures = es.store_many(items)
+        assert_equal([(f['_id'], f['status']) for f in failures],
+                     [("ok", 503), ("bad", 503)])
+        json.dumps(failures)
+    finally:
+        es._es = old
+
+
 def test_fetch():
     "Test whether tasks.fetch works as documented"
     from xtas.tasks.es import fetch, es_document
     # if doc is a string, fetching should return the string
     assert_equal(fetch("Literal string"), "Literal string")
+    assert_equal(fetch(""), u"")
     # index a document and fetch it with an es_document
     with clean_es() as es:
         d = es.index(index=ES_TEST_INDEX, doc_type=ES_TEST_TYPE,
@@ -43,9 +107,24 @@ def test_fetch():
         assert_equal(fetch(doc), "test")
 
 
+def test_fetch_many():
+    "Test whether tasks.fetch_many returns documents in input order"
+    from xtas.tasks.es import fetch_many, es_document
+    with clean_es() as es:
+        docs = []
+        for text in ["one", "two", "three"]:
+            d = es.index(index=ES_TEST_INDEX, doc_type=ES_TEST_TYPE,
+                         body={"text": text})
+            docs.append(es_document(ES_TEST_INDEX, ES_TEST_TYPE, d['_id'],
+                                    "text"))
+        docs.insert(1, "Literal string")
+        assert_equal(list(fetch_many(docs, chunk_size=2)),
+                     ["one", "Literal string", "two", "three"])
+
+
 def test_query_batch():
     "Test getting multiple documents in a batch"
-    from xtas.tasks.es import fetch_query_batch
+    from xtas.tasks.es import fetch_query_batch, fetch_query_batch_handles
     with clean_es() as es:
         es.index(index=ES_TEST_INDEX, doc_type=ES_TEST_TYPE,
                  body={"text": "test", "test": "batch"})
@@ -58,10 +137,24 @@ def test_query_batch():
                               query={"term": {"test": "batch"}}, field="text")
         assert_equal(set(b), {"test", "test2"})
 
+        # Scrolling in small pages should give all matches.
+        b = fetch_query_batch(ES_TEST_INDEX, ES_TEST_TYPE,
+                              query={"term": {"test": "batch"}}, field="text",
+                              page_size=1)
+        assert_equal(set(b), {"test", "test2"})
+
+        handles = fetch_query_batch_handles(ES_TEST_INDEX, ES_TEST_TYPE,
+                                            query={"term": {"test": "batch"}},
+                                            field="text")
+        assert_equal(len(handles), 3)
+        assert_equal({h['field'] for h in handles}, {"text"})
+        assert_equal(len({h['id'] for h in handles}), 3)
+
 
 def test_store_get_result():
     "test whether results can be stored and retrieved"
-    from xtas.tasks.es import store_single, get_single_result, get_all_results
+    from xtas.tasks.es import (store_single, store_many, get_single_result,
+                               get_all_results)
     idx, typ = ES_TEST_INDEX, ES_TEST_TYPE
     with clean_es() as es:
         id = es.index(index=idx, doc_type=typ, body={"text": "test"})['_id']
@@ -92,6 +185,14 @@ def test_store_get_result():
         assert_equal(get_all_results(idx, typ, id),
                      {"task1": "task1_result2", "task2": task2_result})
 
+        # store results in bulk
+        failures = store_many([("task3", idx, typ, id, "task3_result"),
+                               ("task3", idx, typ, "nonexistent", "x")])
+        assert_equal([f['_id'] for f in failures], ["nonexistent"])
+        client.indices.IndicesClient(es).flush()
+        assert_equal(get_single_result("task3", idx, typ, id), "task3_result")
+        assert_equal(get_single_result("task1", idx, typ, id), "task1_result2")
+
         # check that the original document is intact
         src = es.get_source(index=idx, doc_type=typ, id=id)
         assert_equal(src['text'], "test")
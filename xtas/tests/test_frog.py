@@ -4,12 +4,13 @@ Test the Frog lemmatizer functions and task.
 
 import logging
 import socket
+import threading
 from unittest import SkipTest
 
 from nose.tools import assert_equal, assert_not_equal
 
-from xtas.tasks._frog import (FROG_HOST, FROG_PORT, call_frog, frog_to_saf,
-                              parse_frog)
+from xtas.tasks._frog import (FROG_HOST, FROG_PORT, FrogManager, call_frog,
+                              frog_to_saf, frog_to_table, parse_frog)
 
 
 def _check_frog():
@@ -34,6 +35,69 @@ def test_call_frog():
     assert_equal(lines[5], '')
 
 
+class _FakeFrog(object):
+    "Frog server that outputs its port and the number of EOT requests"
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        self.conns = []
+        t = threading.Thread(target=self.serve)
+        t.daemon = True
+        t.start()
+
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            self.conns.append(conn)
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def handle(self, conn):
+        n = 0
+        for line in conn.makefile('r'):
+            if line.strip() == "EOT":
+                n += 1
+                conn.sendall("%d\t%d\nREADY\n" % (self.address[1], n))
+        conn.close()
+
+    def drop(self):
+        "Close all connections, as Frog does with idle ones after a while"
+        for conn in self.conns:
+            conn.shutdown(socket.SHUT_RDWR)
+        del self.conns[:]
+
+
+def test_manager():
+    a, b = _FakeFrog(), _FakeFrog()
+    unused = socket.socket()
+    unused.bind(('127.0.0.1', 0))   # nobody listens here
+    down = unused.getsockname()
+    manager = FrogManager([down, a.address, b.address], connections=1,
+                          persistent=True)
+
+    def call():
+        with manager.connection() as conn:
+            conn.send(["test\n"])
+            return map(int, list(conn.read())[0].split("\t"))
+
+    # the connection to a is reused; down is skipped from now on
+    assert_equal(call(), [a.address[1], 1])
+    assert_equal(call(), [a.address[1], 2])
+    assert_equal([s.is_up() for s in manager.servers], [False, True, True])
+
+    # while a is busy, requests go to b
+    with manager.connection():
+        assert_equal(call(), [b.address[1], 1])
+
+    # a closed its end; the connection is detected as dead and reopened
+    a.drop()
+    assert_equal(call(), [a.address[1], 1])
+
+
 LINES = ['1\tdit\tdit\t[dit]\tVNW(aanw,pron,stan,vol,3o,ev)\t0.9\tO\tB-NP\t2\tsu',
          '2\tis\tzijn\t[zijn]\tWW(pv,tgw,ev)\t0.999017\tO\tB-VP\t0\tROOT',
          '3\tin\tin\t[in]\tVZ(init)\t0.998321\tO\tB-PP\t2\tmod',
@@ -59,6 +123,18 @@ def test_parse_frog():
     assert_equal(tokens[7]['sentence'], 1)
 
 
+def test_frog_to_table():
+    table = frog_to_table(iter(LINES))
+    tokens = list(parse_frog(LINES))
+    assert_equal(table['word'], [t['word'] for t in tokens])
+    assert_equal(table['lemma'][5], 'twee')
+    assert_equal(table['pos_confidence'][0], 0.9)
+    assert_equal(table['ne'][2:4], [None, 'LOC'])
+    assert_equal(table['head'][:2], [1, -1])
+    assert_equal(table['relation'][:2], ['su', 'ROOT'])
+    assert_equal(table['sentence'], [0] * 5 + [1] * 3)
+
+
 def test_frog_to_saf():
     tokens = list(parse_frog(LINES))
     saf = frog_to_saf(tokens)
@@ -4,7 +4,7 @@ Test the pipelining and caching in xtas
 
 from contextlib import contextmanager
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_not_equal, assert_true
 
 from .test_es import clean_es, ES_TEST_INDEX
 
@@ -80,3 +80,126 @@ def test_pipeline_cache():
         # whole pipeline should now be skipped
         r = pipeline(doc, pipe, store_intermediate=True, block=False)
         assert_equal(json.dumps(r), json.dumps(expected_pos))
+
+
+def test_pipeline_batch():
+    "Does pipeline_batch give the same results as pipeline, from cache?"
+    import json
+    from xtas.tasks.single import tokenize, pos_tag
+    from xtas.tasks.pipeline import pipeline, pipeline_batch
+    from xtas.tasks.es import es_document
+    texts = ["cats are furry", "The cat is happy", "dogs bark"]
+    pipe = [{"module": tokenize},
+            {"module": pos_tag, "arguments": {"model": "nltk"}}]
+    with eager_celery(), clean_es() as es:
+        idx, typ = ES_TEST_INDEX, ES_TEST_TYPE
+        docs = [es_document(idx, typ,
+                            es.index(index=idx, doc_type=typ,
+                                     body={"text": text})['_id'],
+                            "text")
+                for text in texts]
+        # cache the tokens of the first document only
+        pipeline(docs[0], pipe[:1])
+        expected = [json.dumps(pipeline(text, pipe)) for text in texts]
+
+        # mix ES documents and a plain string
+        batch = docs + [texts[0]]
+        r = dict(pipeline_batch(batch, pipe, chunk_size=2))
+        assert_equal(sorted(r), [0, 1, 2, 3])
+        assert_equal([json.dumps(r[i]) for i in range(4)],
+                     expected + expected[:1])
+
+        # second time, all results for ES documents come from cache
+        r = list(pipeline_batch(docs, pipe))
+        assert_equal(sorted(i for i, _ in r), [0, 1, 2])
+
+
+def test_pipeline_batch_failures():
+    "Does pipeline_batch report failures per document and go on?"
+    from xtas.tasks.pipeline import pipeline_batch
+    pipe = [{"module": "xtas.tasks.single.guess_language"}]
+    docs = ["Three quarks for muster Mark", 42, "Hello, world"] * 3
+    with eager_celery():
+        r = dict(pipeline_batch(docs, pipe, chunk_size=2, max_groups=2))
+    assert_equal(sorted(r), list(range(len(docs))))
+    for i, doc in enumerate(docs):
+        if doc == 42:
+            assert_true(isinstance(r[i], TypeError))
+        else:
+            assert_equal(len(r[i]), 2)
+
+
+class _FakeResult(object):
+    "Stands in for an AsyncResult; counts state queries"
+    queries = 0
+
+    def __init__(self, state, parent=None):
+        self._state = state
+        self.parent = parent
+
+    @property
+    def state(self):
+        _FakeResult.queries += 1
+        return self._state
+
+
+def test_failed_parent():
+    from xtas.tasks.pipeline import _failed_parent
+    first = _FakeResult('SUCCESS')
+    failed = _FakeResult('FAILURE', first)
+    chain = _FakeResult('PENDING', _FakeResult('PENDING', failed))
+    assert_true(_failed_parent(chain) is failed)
+
+    # Tasks before a successful one are not looked at.
+    _FakeResult.queries = 0
+    running = _FakeResult('PENDING', _FakeResult('SUCCESS', failed))
+    assert_equal(_failed_parent(running), None)
+    assert_equal(_FakeResult.queries, 1)
+
+
+def test_cache_keys():
+    "Are cache keys argument-aware and canonical?"
+    from xtas.tasks.pipeline import _cache_keys, _get_task
+
+    def keys(pipe):
+        return _cache_keys(pipe, [_get_task(t) for t in pipe])
+
+    tokenize = {"module": "xtas.tasks.single.tokenize"}
+    default = keys([tokenize, {"module": "xtas.tasks.single.pos_tag"}])
+    assert_equal(len(default), 2)
+    assert_equal(default[0], keys([tokenize])[0])
+    assert_true(default[1].startswith("pos_tag__"))
+
+    for args in [["nltk"], {"model": "nltk"}]:
+        assert_equal(default, keys([tokenize,
+                                    {"module": "xtas.tasks.single.pos_tag",
+                                     "arguments": args}]))
+
+    other = keys([tokenize, {"module": "xtas.tasks.single.pos_tag",
+                             "arguments": {"model": "other"}}])
+    assert_equal(other[0], default[0])
+    assert_not_equal(other[1], default[1])
+
+    versioned = keys([dict(tokenize, version=2),
+                      {"module": "xtas.tasks.single.pos_tag"}])
+    assert_not_equal(versioned[0], default[0])
+    assert_not_equal(versioned[1], default[1])
+
+
+def test_fuse():
+    "Are runs of fusable tasks fused, and do fused pipelines work?"
+    from xtas.tasks.single import alpino, guess_language, untokenize
+    from xtas.tasks.pipeline import _fuse, pipeline, run_fused
+
+    chain = [untokenize.s(), guess_language.s(), alpino.s(),
+             untokenize.s(), guess_language.s(output="rank")]
+    fused = _fuse(chain)
+    assert_equal([t.task for t in fused],
+                 [run_fused.name, alpino.name, run_fused.name])
+    assert_equal(fused[0].args, ([untokenize.s(), guess_language.s()],))
+
+    tokens = "Three quarks for muster Mark".split()
+    pipe = [{"module": untokenize}, {"module": guess_language}]
+    with eager_celery():
+        assert_equal(list(pipeline(tokens, pipe, fused=True)),
+                     list(pipeline(tokens, pipe)))
@@ -37,6 +37,19 @@ def test_to_conll():
     assert_equal(deps, TEST_CONLL)
 
 
+def test_to_conll_many():
+    "Test conversion of multiple trees in one call"
+    from xtas.tasks._semafor import to_conll_many
+    _check_corenlp_home()
+
+    tree2 = "(ROOT (S (NP (NNP Mary)) (VP (VBZ sleeps))))"
+    results = to_conll_many([TEST_TREE, tree2])
+    assert_equal(len(results), 2)
+    assert_equal([x for x in results[0].split("\n") if x.strip()],
+                 TEST_CONLL)
+    assert_equal(len([x for x in results[1].split("\n") if x.strip()]), 2)
+
+
 def test_semafor():
     "Test raw semafor output"
     from xtas.tasks._semafor import call_semafor
@@ -0,0 +1,59 @@
+"""
+Test the SentiWords tagger.
+"""
+
+import os.path
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_true
+import numpy as np
+
+from xtas.tasks._sentiwords import compile_lexicon, tag
+
+
+def test_longest_match():
+    words = ("the cooper union for the advancement of science and art"
+             " a priori cold").split()
+    assert_equal(list(tag(words)),
+                 [('the', 0),
+                  ('cooper union for the advancement of science and art',
+                   0.12208),
+                  ('a priori', 0.02784), ('cold', -0.17003)])
+
+    # "a" is in SentiWords by itself, too
+    assert_equal(list(tag(["a", "fortiori"])), [('a fortiori', 0.15793)])
+    assert_equal(list(tag(["a", "xyzzy"])), [('a', 0.04128), ('xyzzy', 0)])
+    assert_equal(list(tag([])), [])
+
+
+def test_compile_lexicon():
+    tempdir = tempfile.mkdtemp()
+    try:
+        lexicon = os.path.join(tempdir, "lexicon.txt")
+        with open(lexicon, "w") as f:
+            f.write("# comment\na priori\t.5\nbeer\t.2\ncold\t0\n"
+                    "wisdom of jesus\t-.1\n")
+        compile_lexicon(lexicon, tempdir)
+
+        def load(name):
+            return np.load(os.path.join(tempdir, name + ".npy"),
+                           mmap_mode='r').tolist()
+
+        words = load("words")
+        assert_equal(words, ["a", "beer", "jesus", "of", "priori", "wisdom"])
+        # Nodes: 0 root, 1 a, 2 a priori, 3 beer, 4 wisdom, 5 wisdom of,
+        # 6 wisdom of jesus; edges are keyed parent * len(words) + word.
+        edges = [(e // len(words), words[e % len(words)])
+                 for e in load("edges")]
+        assert_equal(edges, [(0, "a"), (0, "beer"), (0, "wisdom"),
+                             (1, "priori"), (4, "of"), (5, "jesus")])
+        assert_equal(load("children"), [1, 3, 4, 2, 5, 6])
+        priors = load("priors")
+        assert_true(np.isnan(priors[0]) and np.isnan(priors[1]))
+        assert_equal(priors[2:4], [.5, .2])
+        assert_equal(priors[6], -.1)
+        assert_equal(load("extends"),
+                     [True, True, False, False, True, True, False])
+    finally:
+        shutil.rmtree(tempdir)
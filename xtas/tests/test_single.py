@@ -1,7 +1,12 @@
 # coding: utf-8
 
+import json
+import os.path
+import shutil
+import tempfile
+
 from nose.tools import (assert_equal, assert_greater, assert_in, assert_less,
-                        assert_true)
+                        assert_raises, assert_true)
 
 from xtas.tasks import (guess_language, morphy, movie_review_polarity,
                         sentiwords_tag, tokenize, dbpedia_spotlight)
@@ -24,11 +29,37 @@ def test_morphy():
     assert_equal(lemmata, "The cat sat on the mat .".split())
 
 
+def build_polarity_model():
+    """Build the movie review polarity model if it's not there yet."""
+    from xtas.tasks import _polarity
+    try:
+        _polarity.get_model()
+    except IOError:
+        _polarity.build()
+
+
 def test_movie_review_polarity():
+    build_polarity_model()
     # <.5 == probably not positive.
     assert_less(movie_review_polarity("This movie sucks."), .5)
 
 
+def test_polarity_model_check():
+    import sklearn
+    from xtas.tasks import _polarity
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tempdir, "meta.json"), "w") as f:
+            json.dump({"version": _polarity._FORMAT_VERSION,
+                       "sklearn_version": sklearn.__version__,
+                       "files": {"model.pkl": 42}}, f)
+        # A missing file should be reported like a corrupt one.
+        assert_raises(IOError, _polarity._check, tempdir)
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def test_sentiwords():
     bag = sentiwords_tag("I'd like a cold beer.")
     assert_true(isinstance(bag, dict))
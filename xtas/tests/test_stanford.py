@@ -26,3 +26,12 @@ def test_stanford_ner_encoding():
     # but detected in the context of Stanford NER, so a non-regression test.
     stanford_ner_tag('\xe9toile'.decode('latin-1'))
     stanford_ner_tag('\xe9toile')
+
+
+def test_stanford_ner_batch():
+    from xtas.tasks.cluster import stanford_ner_batch
+    phrase = ("Academy Award-winning actor Philip Seymour Hoffman"
+              " dies at the age of 46.")
+    names = stanford_ner_batch([phrase, "", phrase], output="names")
+    assert_equal(names, [[("Philip Seymour Hoffman", "PERSON")], [],
+                         [("Philip Seymour Hoffman", "PERSON")]])
@@ -0,0 +1,43 @@
+"""
+Test xtas._utils.
+"""
+
+from nose.tools import assert_equal, assert_is, assert_is_not
+
+from xtas import _utils
+from xtas.core import _config
+
+
+def test_nltk_resource():
+    loaded = []
+
+    def load():
+        loaded.append(object())
+        return loaded[-1]
+
+    _utils._NLTK_LOADERS['test'] = load
+    try:
+        first = _utils.nltk_resource('test')
+        assert_is(_utils.nltk_resource('test'), first)
+        assert_equal(len(loaded), 1)
+    finally:
+        del _utils._NLTK_LOADERS['test']
+        _utils._nltk_resources.pop('test', None)
+
+
+def test_per_process():
+    @_utils.per_process('TEST')
+    def get(config):
+        return object(), config
+
+    _config['TEST'] = {'a': 1}
+    try:
+        first = get()
+        assert_is(get(), first)
+        assert_equal(first[1], {'a': 1})
+        _config['TEST'] = {'a': 2}
+        assert_is_not(get(), first)
+        assert_equal(get()[1], {'a': 2})
+    finally:
+        del _config['TEST']
+    assert_equal(get()[1], None)
@@ -0,0 +1,26 @@
+"""
+Test loading of resources when a worker process starts.
+"""
+
+from nose.tools import assert_equal, assert_greater_equal
+
+from xtas.tasks import _warmup
+
+
+def test_warm_up():
+    loaded = []
+
+    def fail():
+        raise IOError("resource not available")
+
+    _warmup.RESOURCES['test'] = lambda: loaded.append('test')
+    _warmup.RESOURCES['test_fail'] = fail
+    try:
+        timings = _warmup.warm_up(['test_fail', 'test'])
+    finally:
+        del _warmup.RESOURCES['test'], _warmup.RESOURCES['test_fail']
+
+    # A failing resource is skipped, not fatal.
+    assert_equal(loaded, ['test'])
+    assert_equal(list(timings), ['test'])
+    assert_greater_equal(timings['test'], 0)